@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""This script runs reproducible benchmarks of trie building, morphological database, paradigm guessing and log
+evaluation on synthetic Czech-like data (the real dictionary, paradigms and corpora are not publicly
+available). Data are generated from a seed in given size, results (best time of several runs) are stored
+as JSON and can be compared with a stored baseline to catch regressions."""
+import json
+import os
+import random
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+import db_stats as dbs
+import morph_database as md
+
+CONSONANTS = "bcdfghjklmnprstvzčřšžťď"
+VOWELS = "aeiouyáéíóúůýě"
+SUFFIXES = ["a", "y", "e", "u", "ou", "ami", "ách", "ám", "o", "i", "ů", "ové", "ech", "em", "ům", "ých", "ého",
+            "ému", "ým", "ová", "ní", "nit", "ím", "íš", "í", "íme", "íte", "ít", "al", "ala", "ali", "ěl"]
+FREQ_LIST = f"data{os.sep}cstenten17_mj2.freqlist.cleaned.sorted_alpha"
+DIC_FILE = f"data{os.sep}current.dic"
+PAR_FILE = f"data{os.sep}current.par"
+TEST_FORMS = f"{DIC_FILE}.cleaned.utf8.sorted.forms.filtered"
+
+
+def generate(directory: str, seed: int = 1, scale: int = 1) -> None:
+    """Generates synthetic paradigm file, dictionary and segmented frequency list (40, 600 and about 7000
+    entries times scale) in data subdirectory of given directory, and derives the other data files from them
+    (see build.py). Words are random syllables with Czech letters, the list contains forms of dictionary
+    lemmas, of unknown lemmas following the paradigms and random noise words."""
+    import build
+    rng = random.Random(seed)
+    for subdirectory in ("data", "logs", "temp", "results"):
+        os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+    def syllables(low: int, high: int) -> str:
+        return "".join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(rng.randint(low, high)))
+
+    paradigms = dict()
+    for p in range(40 * scale):
+        suffixes = rng.sample(SUFFIXES, rng.randint(4, 12))
+        paradigms[syllables(2, 2) + suffixes[0] + ("" if p % 3 else f"_x{p % 7 + 1}")] = suffixes
+    with open(os.path.join(directory, PAR_FILE), "w", encoding="windows-1250") as f:
+        for name, suffixes in paradigms.items():
+            f.write(f"={name}_al\n")
+            f.writelines(f"\t{{{suffix},k{1 + i % 5}gFnSc{1 + i % 7}}}\n" for i, suffix in enumerate(suffixes))
+        for name in paradigms:
+            f.write(f"+{name}\n\t<> {name}_al\n")
+    names = list(paradigms)
+    vocab = set()
+    for _ in range(600 * scale):
+        name = rng.choice(names)
+        vocab.add((syllables(1, 3) + paradigms[name][0], name))
+    vocab = sorted(vocab)
+    with open(os.path.join(directory, DIC_FILE), "w", encoding="windows-1250") as f:
+        f.writelines(f"{lemma}:{name}|1.0\n" for lemma, name in vocab)
+    freq = dict()
+    for lemma, name in vocab:
+        root = lemma[:len(lemma) - len(paradigms[name][0])]
+        for suffix in paradigms[name]:
+            if rng.random() < 0.8:
+                freq[root + suffix] = freq.get(root + suffix, 0) + rng.randint(1, 3000)
+    for _ in range(150 * scale):
+        name = rng.choice(names)
+        root = syllables(1, 3)
+        for suffix in paradigms[name]:
+            if rng.random() < 0.9:
+                freq[root + suffix] = freq.get(root + suffix, 0) + rng.randint(50, 3000)
+    for _ in range(3000 * scale):
+        word = syllables(1, 3) + rng.choice(SUFFIXES)
+        freq[word] = freq.get(word, 0) + rng.randint(1, 500)
+    words = sorted(freq)
+    with open(os.path.join(directory, FREQ_LIST), "w", encoding="utf-8") as f:
+        f.writelines(f"{word}\t{freq[word]}\n" for word in words)
+    with open(os.path.join(directory, f"{FREQ_LIST}.character"), "w", encoding="utf-8") as f:
+        f.writelines(f"{'='.join(word)}\t{word}\t{freq[word]}\n" for word in words)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        build.build([])
+    finally:
+        os.chdir(cwd)
+    import shutil
+    shutil.copy(os.path.join(directory, f"{FREQ_LIST}.character"),
+                os.path.join(directory, f"{FREQ_LIST}.lowdrop.character"))
+
+
+BENCHMARKS = dict()
+
+
+def benchmark(name: str, kind: str = "micro"):
+    """Registers benchmark of given name and kind (micro or end-to-end). Benchmark function prepares its
+    state and returns function whose run is measured."""
+    def decorator(function):
+        BENCHMARKS[name] = (kind, function)
+        return function
+    return decorator
+
+
+class Workload:
+    """Data shared by benchmarks, built lazily in current (data) directory."""
+    def __init__(self):
+        self.cached = dict()
+
+    def get(self, name: str, build: Callable[[], Any]) -> Any:
+        """Returns shared object of given name, built by given function on first use."""
+        if name not in self.cached:
+            self.cached[name] = build()
+        return self.cached[name]
+
+    @property
+    def morph_db(self) -> md.MorphDatabase:
+        return self.get("morph_db", lambda: md.MorphDatabase(DIC_FILE, PAR_FILE, f"{FREQ_LIST}.filtered"))
+
+    @property
+    def tree(self) -> dbs.FreqTreeNode:
+        return self.get("tree", lambda: dbs.FreqTreeNode().feed(f"{FREQ_LIST}.character"))
+
+    @property
+    def test_forms(self) -> List[List[str]]:
+        return self.get("test_forms", read_test_forms)
+
+
+def read_test_forms() -> List[List[str]]:
+    """Returns split lines <form:lemma:paradigm> of test forms file."""
+    with open(TEST_FORMS, encoding="utf-8") as f:
+        return [line.strip().split(":") for line in f]
+
+
+@benchmark("trie_feed")
+def trie_feed(workload: Workload):
+    return lambda: dbs.FreqTreeNode().feed(f"{FREQ_LIST}.character")
+
+
+@benchmark("compact_trie_feed")
+def compact_trie_feed(workload: Workload):
+    return lambda: dbs.CompactFreqTree().feed(f"{FREQ_LIST}.character")
+
+
+@benchmark("trie_suffixes")
+def trie_suffixes(workload: Workload):
+    tree = workload.tree
+    prefixes = sorted({form[:length] for form, _, _ in workload.test_forms for length in (1, 2, 3)})
+    return lambda: [tree.suffixes(prefix) for prefix in prefixes]
+
+
+@benchmark("morph_db_build")
+def morph_db_build(workload: Workload):
+    return lambda: md.MorphDatabase(DIC_FILE, PAR_FILE, f"{FREQ_LIST}.filtered")
+
+
+@benchmark("load_database_snapshot")
+def load_database_snapshot(workload: Workload):
+    md.load_database(DIC_FILE, PAR_FILE, f"{FREQ_LIST}.filtered")
+    return lambda: md.load_database(DIC_FILE, PAR_FILE, f"{FREQ_LIST}.filtered")
+
+
+@benchmark("lemmatize")
+def lemmatize(workload: Workload):
+    morph_db = workload.morph_db
+    forms = [form for form, _, _ in workload.test_forms] * 20
+    paradigms = [paradigm for _, _, paradigm in workload.test_forms] * 20
+    return lambda: morph_db.lemmatize_many(forms, paradigms)
+
+
+@benchmark("tree_spread_scores")
+def tree_spread_scores(workload: Workload):
+    morph_db, tree = workload.morph_db, workload.tree
+    words = [dbs.uppercase_format("=".join(form)) for form, _, _ in workload.test_forms]
+    return lambda: [dbs.tree_spread_scores(segments, tree, morph_db, dbs.scoring_comm_square_spread_suf)
+                    for segments in words]
+
+
+@benchmark("guess_forms", "end-to-end")
+def guess_forms(workload: Workload):
+    import compare_segmenters as cs
+    morph_db = workload.morph_db
+    return lambda: cs.tree_guess(TEST_FORMS, f"{FREQ_LIST}.character", morph_db, "character",
+                                 f"logs{os.sep}log_character_forms")
+
+
+@benchmark("eval_logs", "end-to-end")
+def eval_logs(workload: Workload):
+    import eval_logs as el
+    if not os.path.exists(f"logs{os.sep}log_character_forms"):
+        guess_forms(workload)()
+    morph_db = workload.morph_db
+    el.init_worker(morph_db, 1, 5)
+
+    def evaluate():
+        morph_db.comparisons = dict()
+        morph_db.lemma_memo = dict()
+        return el.full_report(f"logs{os.sep}log_character_forms")
+    return evaluate
+
+
+@benchmark("new_dic", "end-to-end")
+def new_dic(workload: Workload):
+    import new_dic as nd
+    return nd.main
+
+
+def run(names: List[str], repeat: int = 5, min_time: float = 0.1) -> Dict[str, Dict[str, Any]]:
+    """Runs given benchmarks in current (data) directory, each repeat times with fresh state. Fast benchmarks
+    are run in loops lasting at least min_time. Returns best and all times of one call of each benchmark."""
+    from math import ceil
+    from sys import stderr
+    workload = Workload()
+    results = dict()
+    for name in names:
+        kind, function = BENCHMARKS[name]
+        measured = function(workload)
+        start = perf_counter()
+        measured()
+        loops = max(1, ceil(min_time / max(perf_counter() - start, 1e-6)))
+        times = []
+        for _ in range(repeat):
+            measured = function(workload)
+            start = perf_counter()
+            for _ in range(loops):
+                measured()
+            times.append((perf_counter() - start) / loops)
+        results[name] = {"kind": kind, "seconds": round(min(times), 6), "loops": loops,
+                         "runs": [round(t, 6) for t in times]}
+        print(f"{name}: {results[name]['seconds']:.4f}s", file=stderr)
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.5) -> List[str]:
+    """Prints ratio of times of benchmarks to their baseline. Returns names of benchmarks slower than baseline
+    by more than tolerance (as a fraction)."""
+    regressions = []
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name:24} {result['seconds']:10.4f}s  (no baseline)")
+            continue
+        base = baseline["results"][name]["seconds"]
+        ratio = result["seconds"] / base if base else 1.0
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:24} {result['seconds']:10.4f}s  baseline {base:10.4f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    import argparse
+    import platform
+    import sys
+    import instrument
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic data, optionally compared with baseline")
+    parser.add_argument("-d", "--directory", help="directory of synthetic data (default temp/benchmark_<seed>_<scale>)")
+    parser.add_argument("-s", "--seed", type=int, default=1, help="seed of data generator")
+    parser.add_argument("-x", "--scale", type=int, default=1, help="size of data as multiple of the base size")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs of each benchmark (best time is taken)")
+    parser.add_argument("-k", "--select", default="", help="run only benchmarks whose names contain this string")
+    parser.add_argument("-o", "--output", help="JSON file to store results to")
+    parser.add_argument("-b", "--baseline", help="JSON results to compare with (exit status 1 on regression)")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.5,
+                        help="allowed slowdown against baseline as a fraction")
+    args = parser.parse_args()
+    directory = os.path.abspath(args.directory or f"temp{os.sep}benchmark_{args.seed}_{args.scale}")
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    if not os.path.exists(os.path.join(directory, TEST_FORMS)):
+        print(f"Generating data in {directory}...", file=sys.stderr)
+        generate(directory, args.seed, args.scale)
+    os.chdir(directory)
+    results = {"info": {"seed": args.seed, "scale": args.scale, "repeat": args.repeat,
+                        "python": platform.python_version(), "machine": platform.machine()},
+               "results": run([name for name in BENCHMARKS if args.select in name], args.repeat)}
+    results["info"]["peak_rss_kb"] = instrument.peak_rss()
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""This script rebuilds derived data files (cleaned and sorted word list, forms of the morphological database,
+filtered word list, test forms and segmented word lists) only when their inputs change. Content hashes and
+row counts of the files, hashes of paradigms and dictionary entries are recorded in a build manifest, so when
+only some paradigms in current.par or lemmas in current.dic change, only rows of affected lemmas are
+regenerated."""
+import json
+import os
+import subprocess
+from collections import Counter
+from sys import stderr
+from typing import Any, Dict, List, Set, Tuple
+import db_stats as dbs
+import morph_database as md
+
+DIC_FILE = f"data{os.sep}current.dic"
+PAR_FILE = f"data{os.sep}current.par"
+FREQ_LIST = f"data{os.sep}cstenten17_mj2.freqlist"
+SORTED_FREQ_LIST = f"{FREQ_LIST}.cleaned.sorted_alpha"
+FORMS = f"{DIC_FILE}.cleaned.utf8.sorted.forms"
+MANIFEST = f"temp{os.sep}build_manifest.json"
+
+
+def load_manifest(manifest: str = MANIFEST) -> Dict[str, Any]:
+    """Returns build manifest, or empty one if it does not exist."""
+    if not os.path.exists(manifest):
+        return {"files": dict(), "paradigms": dict(), "vocab": dict()}
+    with open(manifest, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(data: Dict[str, Any], manifest: str = MANIFEST) -> None:
+    """Stores build manifest."""
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    with open(f"{manifest}.tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(f"{manifest}.tmp", manifest)
+
+
+def file_record(file: str) -> Dict[str, Any]:
+    """Returns size, modification time, SHA-1 hash and number of lines of file."""
+    import hashlib
+    digest = hashlib.sha1()
+    rows = 0
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+            rows += block.count(b"\n")
+    return {"size": os.path.getsize(file), "mtime": os.stat(file).st_mtime_ns, "hash": digest.hexdigest(),
+            "rows": rows}
+
+
+def unchanged(data: Dict[str, Any], file: str) -> bool:
+    """Checks whether file exists and has the content recorded in manifest (compared by size and modification
+    time, or by hash if they differ)."""
+    record = data["files"].get(file)
+    if record is None or not os.path.exists(file):
+        return False
+    if record["size"] == os.path.getsize(file) and record["mtime"] == os.stat(file).st_mtime_ns:
+        return True
+    if record["hash"] != md.file_hash(file):
+        return False
+    record["mtime"] = os.stat(file).st_mtime_ns
+    return True
+
+
+def record(data: Dict[str, Any], *files: str) -> None:
+    """Records current content of files in manifest."""
+    for file in files:
+        data["files"][file] = file_record(file)
+        print(f"{file}: {data['files'][file]['rows']} rows", file=stderr)
+
+
+def sort_file(file: str, outfile: str, *args: str) -> None:
+    """Sorts file to outfile by sort utility with given arguments."""
+    subprocess.run(["sort", *args, f"--output={outfile}", file], check=True)
+
+
+def paradigm_hashes(morph_db: md.MorphDatabase) -> Dict[str, str]:
+    """Returns hash of definition of each paradigm in database."""
+    import hashlib
+    return {paradigm: hashlib.sha1(repr(definition).encode("utf-8")).hexdigest()
+            for paradigm, definition in morph_db.paradigms.items()}
+
+
+def vocab_counts(morph_db: md.MorphDatabase) -> Dict[str, int]:
+    """Returns number of occurrences of each entry <lemma:paradigm> in vocabulary of database."""
+    return dict(Counter(f"{lemma}:{paradigm}" for lemma, paradigm in morph_db.vocab))
+
+
+def affected_entries(data: Dict[str, Any], paradigms: Dict[str, str], vocab: Dict[str, int]) -> Set[Tuple[str, str]]:
+    """Returns entries (lemma, paradigm) added to or removed from vocabulary since the last build, or using
+    a paradigm with changed definition."""
+    changed = {paradigm for paradigm in set(paradigms) | set(data["paradigms"])
+               if paradigms.get(paradigm) != data["paradigms"].get(paradigm)}
+    affected = set()
+    for entry in set(vocab) | set(data["vocab"]):
+        lemma, paradigm = entry.split(":")
+        if vocab.get(entry) != data["vocab"].get(entry) or paradigm in changed:
+            affected.add((lemma, paradigm))
+    return affected
+
+
+def update_forms(forms_file: str, morph_db: md.MorphDatabase, affected: Set[Tuple[str, str]]) -> None:
+    """Replaces lines <form:lemma:paradigm> of affected entries in sorted forms file by their current forms.
+    Kept and new lines are merged by sort -f -m."""
+    with open(forms_file, encoding="utf-8") as f, open(f"{forms_file}.kept", "w", encoding="utf-8") as kept:
+        kept.writelines(line for line in f if tuple(line.rstrip("\n").split(":")[1:]) not in affected)
+    with open(f"{forms_file}.added", "w", encoding="utf-8") as added:
+        for lemma, paradigm in morph_db.vocab:
+            if (lemma, paradigm) in affected:
+                added.writelines(f"{form}:{lemma}:{paradigm}\n" for form in morph_db.lemma_forms(lemma, paradigm))
+    sort_file(f"{forms_file}.added", f"{forms_file}.added", "-f")
+    subprocess.run(["sort", "-f", "-m", f"--output={forms_file}", f"{forms_file}.kept", f"{forms_file}.added"],
+                   check=True)
+    os.remove(f"{forms_file}.kept")
+    os.remove(f"{forms_file}.added")
+
+
+def update_filtered(freq_list: str, morph_db: md.MorphDatabase, affected: Set[Tuple[str, str]]) -> None:
+    """Replaces lines of affected entries in filtered frequency list (see db_stats.filter_freqlist) by lines
+    of their current forms. Frequency list and old filtered list are read in one streaming pass."""
+    added = dbs.forms_sources(morph_db, affected)
+    filtered = f"{freq_list}.filtered"
+    with open(freq_list, encoding="utf-8") as fl, open(filtered, encoding="utf-8") as old, \
+            open(f"{filtered}.tmp", "w", encoding="utf-8", buffering=1 << 20) as out:
+        row = old.readline()
+        for line in fl:
+            sources = []
+            while row and row.split("\t", 2)[2] == line:
+                paradigm, lemma, _ = row.split("\t", 2)
+                if (lemma, paradigm) not in affected:
+                    sources.append((lemma, paradigm))
+                row = old.readline()
+            word = line.split()[0]
+            if word in added:
+                sources = sorted(sources + added[word], key=dbs.source_order)
+            out.writelines(f"{paradigm}\t{lemma}\t{line}" for lemma, paradigm in sources)
+    os.replace(f"{filtered}.tmp", filtered)
+
+
+def update_segmented(freq_list: str, seg_tool: str) -> None:
+    """Updates segmented frequency list (see db_stats.segment_freq_list) after change of frequency list.
+    Segmentations of words already present in the old list are reused, only new words are segmented. Both
+    lists are expected in the same (locale) order as produced by sort."""
+    import locale
+    import guesser as g
+    locale.setlocale(locale.LC_COLLATE, "")
+    segmented = f"{freq_list}.{seg_tool}"
+    segment = g.cached_segment_method(seg_tool)
+    reused = 0
+    with open(freq_list, encoding="utf-8") as fl, open(segmented, encoding="utf-8") as old, \
+            open(f"{segmented}.tmp", "w", encoding="utf-8", buffering=1 << 20) as out:
+        row = old.readline()
+        for line in fl:
+            line = line.strip()
+            word = line.split()[0]
+            while row and row.split("\t", 2)[1] != word and locale.strcoll(row.split("\t", 1)[1].strip(), line) < 0:
+                row = old.readline()
+            if row and row.split("\t", 2)[1] == word:
+                segments = row.split("\t", 1)[0]
+                reused += 1
+            else:
+                segments = "=".join(segment(word))
+            out.write(f"{segments}\t{line}\n")
+    g.flush_segmentations(segment)
+    os.replace(f"{segmented}.tmp", segmented)
+    print(f"{segmented}: {reused} segmentations reused", file=stderr)
+
+
+def build(seg_tools: List[str], full: bool = False, manifest: str = MANIFEST) -> None:
+    """Brings derived data files up to date with the dictionary, paradigm and frequency list files. Without
+    the original frequency list (which is owned by third party), its sorted version is taken as input."""
+    data = {"files": dict(), "paradigms": dict(), "vocab": dict()} if full else load_manifest(manifest)
+
+    sorted_hash = data["files"].get(SORTED_FREQ_LIST, dict()).get("hash")
+    if os.path.exists(FREQ_LIST) and not (unchanged(data, FREQ_LIST) and unchanged(data, SORTED_FREQ_LIST)):
+        print("Cleaning and sorting frequency list...", file=stderr)
+        dbs.clean_freqlist(FREQ_LIST)
+        sort_file(f"{FREQ_LIST}.cleaned", SORTED_FREQ_LIST, "-k1")
+        record(data, FREQ_LIST, SORTED_FREQ_LIST)
+    elif not unchanged(data, SORTED_FREQ_LIST):
+        record(data, SORTED_FREQ_LIST)
+    freq_changed = data["files"][SORTED_FREQ_LIST]["hash"] != sorted_hash
+
+    if not (unchanged(data, DIC_FILE) and unchanged(data, f"{DIC_FILE}.cleaned.utf8.sorted")):
+        print("Cleaning and sorting dictionary...", file=stderr)
+        md.clean_dic_file(DIC_FILE)
+        sort_file(f"{DIC_FILE}.cleaned.utf8", f"{DIC_FILE}.cleaned.utf8.sorted", "-f")
+        record(data, DIC_FILE, f"{DIC_FILE}.cleaned.utf8.sorted")
+    save_manifest(data, manifest)
+
+    morph_db = md.MorphDatabase(DIC_FILE, PAR_FILE)
+    paradigms, vocab = paradigm_hashes(morph_db), vocab_counts(morph_db)
+    if unchanged(data, FORMS) and data["vocab"]:
+        affected = affected_entries(data, paradigms, vocab)
+        if affected:
+            print(f"Updating forms of {len(affected)} entries...", file=stderr)
+            update_forms(FORMS, morph_db, affected)
+            record(data, FORMS)
+    else:
+        affected = None
+        print("Creating all forms...", file=stderr)
+        morph_db.dic_file_all_forms(f"{DIC_FILE}.cleaned.utf8.sorted")
+        sort_file(FORMS, FORMS, "-f")
+        record(data, FORMS)
+
+    filtered = f"{SORTED_FREQ_LIST}.filtered"
+    if affected is None or freq_changed or not unchanged(data, filtered):
+        print("Filtering frequency list...", file=stderr)
+        dbs.filter_freqlist(SORTED_FREQ_LIST, FORMS)
+        record(data, filtered)
+    elif affected:
+        print(f"Updating {filtered}...", file=stderr)
+        update_filtered(SORTED_FREQ_LIST, morph_db, affected)
+        record(data, filtered)
+
+    if affected is None or affected or not unchanged(data, f"{FORMS}.filtered"):
+        dbs.test_forms(FORMS)
+        record(data, f"{FORMS}.filtered")
+    data["paradigms"], data["vocab"] = paradigms, vocab
+    save_manifest(data, manifest)
+
+    source = data["files"][SORTED_FREQ_LIST]["hash"]
+    for seg_tool in seg_tools:
+        segmented = f"{SORTED_FREQ_LIST}.{seg_tool}"
+        if unchanged(data, segmented) and data["files"][segmented].get("source") == source:
+            continue
+        if os.path.exists(segmented):
+            print(f"Updating {segmented}...", file=stderr)
+            update_segmented(SORTED_FREQ_LIST, seg_tool)
+        else:
+            import guesser as g
+            print(f"Segmenting {SORTED_FREQ_LIST} by {seg_tool}...", file=stderr)
+            dbs.segment_freq_list(SORTED_FREQ_LIST, g.cached_segment_method(seg_tool), seg_tool)
+        record(data, segmented)
+        data["files"][segmented]["source"] = source
+        save_manifest(data, manifest)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Rebuilds derived data files affected by changes of inputs. "
+                                                 "Updated rows of the filtered list match a full rebuild only if "
+                                                 "word list and forms are sorted by code point (LC_ALL=C).")
+    parser.add_argument("-s", "--use-segmenter", action="append", default=[],
+                        help="also keep frequency list segmented by this segmenter up to date (repeatable)")
+    parser.add_argument("-f", "--full", action="store_true", default=False,
+                        help="ignore build manifest and rebuild everything")
+    args = parser.parse_args()
+    build(args.use_segmenter, args.full)
+
+
+if __name__ == "__main__":
+    main()
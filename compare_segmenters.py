@@ -2,10 +2,12 @@
 """This script serves for computing precision of paradigm determining when using
 some of supported (SentencePiece, Morfessor, Substitus, HFT) segmentation tools."""
 import sys
+import instrument
 import morph_database as md
 import guesser as g
 import db_stats as dbs
 from os import sep, path, mkdir
+from typing import Any, Dict, List, Tuple
 
 
 def character_guess(corpus: str, morph_db: md.MorphDatabase) -> None:
@@ -14,75 +16,119 @@ def character_guess(corpus: str, morph_db: md.MorphDatabase) -> None:
 
 
 def segmented_tree_guess(freq_list: str, morph_db: md.MorphDatabase, segmenter: str = "", only_lemmas: bool = False,
-                         debug: bool = False) -> None:
+                         debug: bool = False, compact: bool = False, use_numpy: bool = False, jobs: int = 1) -> None:
     """For given tool, guesses paradigms for all entries in test set."""
-    if debug:
-        log_file = sys.stdout
-    else:
-        log_file = open(f"logs{sep}log_{segmenter}_{'lemmas' if only_lemmas else 'forms'}", "w", encoding="utf-8")
     if only_lemmas:
         test_vocab = f"data{sep}current.dic.cleaned.utf8.sorted"
     else:
         test_vocab = f"data{sep}current.dic.cleaned.utf8.sorted.forms.filtered"
-    segment = g.get_segment_method(segmenter)
-    start_letter = "a"
-    node = dbs.FreqTreeNode().feed(freq_list, "a")
-    with open(test_vocab, encoding="utf-8") as test:
-        for line in test:
-            print(line.strip(), file=log_file)
-            segments = dbs.uppercase_format("=".join(segment(line.strip().split(":")[0])).lower())
-            if segments[0] != start_letter:
-                start_letter = segments[0]
-                node = dbs.FreqTreeNode().feed(freq_list, start_letter)
-            data = line.strip().split(":")
-            for form in morph_db.lemma_forms(data[-2], data[-1]):
-                morph_db.paradigms[data[-1]]["spread"][
-                    data[0][len(morph_db.word_root(data[-2], data[-1])):]] -= node[form]
-            scores = g.tree_guess_paradigm_from_corpus(segments, node, morph_db, dbs.scoring_comm_square_spread_suf,
-                                                       only_lemmas)
-            print("\t" + ", ".join([par for _, par in scores]), file=log_file)
-            for form in morph_db.lemma_forms(data[-2], data[-1]):
-                morph_db.paradigms[data[-1]]["spread"][
-                    data[0][len(morph_db.word_root(data[-2], data[-1])):]] += node[form]
-    if not debug:
-        log_file.close()
+    log_name = f"logs{sep}log_{segmenter}_{'lemmas' if only_lemmas else 'forms'}"
+    tree_guess(test_vocab, freq_list, morph_db, segmenter, log_name, only_lemmas, debug, compact, use_numpy, jobs)
 
 
-def substitus_segmented_tree_guess(morph_db: md.MorphDatabase, only_lemmas: bool = False, debug: bool = False) -> None:
+def substitus_segmented_tree_guess(morph_db: md.MorphDatabase, only_lemmas: bool = False, debug: bool = False,
+                                   compact: bool = False, use_numpy: bool = False, jobs: int = 1) -> None:
     """Guesses paradigms for all entries in test set, modified for Substitus."""
     freq_list = f"data{sep}cstenten17_mj2.freqlist.cleaned.sorted_alpha.substitus"
-    if debug:
-        log_file = sys.stdout
-    else:
-        log_file = open(f"logs{sep}log_substitus_{'lemmas' if only_lemmas else 'forms'}", "w", encoding="utf-8")
     if only_lemmas:
         test_vocab = f"data{sep}current.dic.cleaned.utf8.sorted.substitus"
     else:
         test_vocab = f"data{sep}current.dic.cleaned.utf8.sorted.forms.filtered.substitus"
-    start_letter = "a"
-    node = dbs.FreqTreeNode().feed(freq_list, "a")
-    with open(test_vocab, encoding="utf-8") as test:
-        for line in test:
-            data = line.strip().split(maxsplit=1)
-            print(data[1], file=log_file)
-            segments = dbs.uppercase_format(data[0].lower())
-            if segments[0] != start_letter:
-                start_letter = segments[0]
-                node = dbs.FreqTreeNode().feed(freq_list, start_letter)
-            data = data[1].strip().split(":")
-            for form in morph_db.lemma_forms(data[-2], data[-1]):
-                morph_db.paradigms[data[-1]]["spread"][
-                    data[0][len(morph_db.word_root(data[-2], data[-1])):]] -= node[form]
-            scores = g.tree_guess_paradigm_from_corpus(segments, node, morph_db, dbs.scoring_comm_square_spread_suf,
-                                                       only_lemmas)
-            print("\t" + ", ".join([par for _, par in scores]), file=log_file)
-            for form in morph_db.lemma_forms(data[-2], data[-1]):
-                morph_db.paradigms[data[-1]]["spread"][
-                    data[0][len(morph_db.word_root(data[-2], data[-1])):]] += node[form]
+    log_name = f"logs{sep}log_substitus_{'lemmas' if only_lemmas else 'forms'}"
+    tree_guess(test_vocab, freq_list, morph_db, "substitus", log_name, only_lemmas, debug, compact, use_numpy, jobs)
+
+
+def tree_guess(test_vocab: str, freq_list: str, morph_db: md.MorphDatabase, segmenter: str, log_name: str,
+               only_lemmas: bool = False, debug: bool = False, compact: bool = False, use_numpy: bool = False,
+               jobs: int = 1) -> None:
+    """Guesses paradigms for all entries in test set and writes them to log (standard output in debug mode).
+    With more jobs, test set is sharded by start letter among worker processes and their logs are merged
+    in the order of test set. Letter index of the frequency list is built before the workers start."""
+    log_file = sys.stdout if debug else open(log_name, "w", encoding="utf-8")
+    if jobs > 1:
+        from multiprocessing import Pool
+        shards = dict()
+        with open(test_vocab, encoding="utf-8") as test:
+            for i, line in enumerate(test):
+                shards.setdefault(shard_key(line, segmenter == "substitus"), []).append((i, line))
+        records = [""] * sum(len(shard) for shard in shards.values())
+        if not compact:
+            dbs.letter_index(freq_list)
+        with Pool(jobs, initializer=init_worker,
+                  initargs=(freq_list, morph_db, segmenter, only_lemmas, compact, use_numpy,
+                            instrument.settings())) as pool:
+            for guessed, measured in pool.imap_unordered(guess_shard, sorted(shards.values(), key=len,
+                                                                             reverse=True)):
+                instrument.merge(measured)
+                for i, record in guessed:
+                    records[i] = record
+        with instrument.stage("log_writing"):
+            log_file.writelines(records)
+    else:
+        init_worker(freq_list, morph_db, segmenter, only_lemmas, compact, use_numpy)
+        with open(test_vocab, encoding="utf-8") as test:
+            for line in test:
+                record = guess_line(line)
+                with instrument.stage("log_writing"):
+                    log_file.write(record)
+        g.flush_segmentations(WORKER["segment"])
     if not debug:
         log_file.close()
 
 
+def shard_key(line: str, segmented: bool = False) -> str:
+    """Returns start letter of the word on a line of test set (pre-segmented if segmented is set) the way
+    guess_line passes it to FreqTreeLoader.tree_for, i.e. lowercased and without segmentation marks, so words
+    guessed with the same tree share a shard."""
+    word = line.split(maxsplit=1)[0] if segmented else line.split(":")[0]
+    return word.lower().lstrip("¦=▁")[:1]
+
+
+WORKER = dict()
+
+
+def init_worker(freq_list: str, morph_db: md.MorphDatabase, segmenter: str, only_lemmas: bool, compact: bool,
+                use_numpy: bool, instrumentation: Tuple[bool, str] = (False, "")) -> None:
+    """Prepares database, tree loader and segmentation method for guessing in current process. Instrumentation
+    is enabled by settings of the main process (see instrument.settings)."""
+    instrument.enable_worker(instrumentation)
+    WORKER["morph_db"] = morph_db
+    WORKER["segment"] = None if segmenter == "substitus" else g.cached_segment_method(segmenter)
+    WORKER["trees"] = dbs.FreqTreeLoader(freq_list, whole=compact)
+    WORKER["matrix"] = dbs.SpreadMatrix(morph_db) if use_numpy else None
+    WORKER["only_lemmas"] = only_lemmas
+
+
+def guess_shard(shard: List[Tuple[int, str]]) -> Tuple[List[Tuple[int, str]], Dict[str, Any]]:
+    """Guesses paradigms for numbered lines of test set. Returns numbered log records and measurements of
+    the shard (see instrument.snapshot)."""
+    guessed = [(i, guess_line(line)) for i, line in shard]
+    g.flush_segmentations(WORKER["segment"])
+    instrument.dump_profile()
+    return guessed, instrument.snapshot(reset=True)
+
+
+def guess_line(line: str) -> str:
+    """Guesses paradigms for one line of test set (pre-segmented in case of Substitus), excluding the spread of
+    its own forms. Returns log record."""
+    morph_db = WORKER["morph_db"]
+    if WORKER["segment"] is None:
+        segmentation, entry = line.strip().split(maxsplit=1)
+        segments = dbs.uppercase_format(segmentation.lower())
+    else:
+        entry = line.strip()
+        with instrument.stage("segmentation"):
+            segments = dbs.uppercase_format("=".join(WORKER["segment"](entry.split(":")[0])).lower())
+    node = WORKER["trees"].tree_for(segments)
+    data = entry.strip().split(":")
+    own_spread = sum(node[form] for form in morph_db.lemma_forms(data[-2], data[-1]))
+    spread_delta = {data[-1]: {data[0][len(morph_db.word_root(data[-2], data[-1])):]: -own_spread}}
+    scores = g.tree_guess_paradigm_from_corpus(segments, node, morph_db, dbs.scoring_comm_square_spread_suf,
+                                               WORKER["only_lemmas"], WORKER["matrix"], spread_delta,
+                                               WORKER["trees"].cache)
+    return f"{entry}\n\t{', '.join([par for _, par in scores])}\n"
+
+
 def main():
     from time import time
     import argparse
@@ -90,21 +136,36 @@ def main():
     parser.add_argument("-s", "--segmenter", default="")
     parser.add_argument("-d", "--debug", action="store_true", default=False)
     parser.add_argument("-l", "--lemmas", action="store_true", default=False)
+    parser.add_argument("-c", "--compact", action="store_true", default=False)
+    parser.add_argument("-n", "--numpy", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-P", "--profile", default="",
+                        help="write stage timers and counters to PROFILE.json and cProfile dump to PROFILE.prof "
+                             "(including worker processes)")
     args = parser.parse_args()
     if not path.exists(f".{sep}temp"):
         mkdir(f".{sep}temp")
+    if args.profile:
+        instrument.enable(f"{args.profile}.prof")
     start = time()
-    morph_db = md.MorphDatabase(f"data{sep}current.dic", f"data{sep}current.par",
+    morph_db = md.load_database(f"data{sep}current.dic", f"data{sep}current.par",
                                 freq_list=f"data{sep}cstenten17_mj2.freqlist.cleaned.sorted_alpha.filtered")
     fl = f"data{sep}cstenten17_mj2.freqlist.cleaned.sorted_alpha.{args.segmenter if args.segmenter else 'character'}"
     if not path.exists(fl):
         print(fl, " file not found")
         return
     if args.segmenter == "substitus":
-        substitus_segmented_tree_guess(morph_db, only_lemmas=args.lemmas, debug=args.debug)
+        substitus_segmented_tree_guess(morph_db, only_lemmas=args.lemmas, debug=args.debug, compact=args.compact,
+                                       use_numpy=args.numpy, jobs=args.jobs)
     else:
-        segmented_tree_guess(fl, morph_db, segmenter=args.segmenter, only_lemmas=args.lemmas, debug=args.debug)
+        segmented_tree_guess(fl, morph_db, segmenter=args.segmenter, only_lemmas=args.lemmas, debug=args.debug,
+                             compact=args.compact, use_numpy=args.numpy, jobs=args.jobs)
     print(f"finished in {round(time() - start)}s")
+    if args.profile:
+        instrument.dump_profile()
+        instrument.report(f"{args.profile}.json", {"segmenter": args.segmenter, "lemmas": args.lemmas,
+                                                   "compact": args.compact, "numpy": args.numpy,
+                                                   "jobs": args.jobs, "seconds": round(time() - start, 3)})
 
 
 if __name__ == "__main__":
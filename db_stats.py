@@ -1,7 +1,13 @@
 """This file contains tools for handling queries on corpora."""
+import instrument
 import morph_database as md
-from typing import Dict, List, Set, Tuple
-from sys import stdout
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from sys import stdout, stderr
+
+LETTER_INDEX = Optional[Dict[str, List[Tuple[int, int]]]]
+SPREAD_DELTA = Optional[Dict[str, Dict[str, int]]]
 
 
 class FreqTreeNode:
@@ -12,54 +18,388 @@ class FreqTreeNode:
 
     def add(self, word: str, freq: int):
         """Integrate word and its frequency into a tree."""
-        if not word:
-            self.value = freq
-            return
-        else:
-            if word[0] not in self.children.keys():
-                self.children[word[0]] = FreqTreeNode()
-            self.children[word[0]].add(word[1:], freq)
+        node = self
+        for letter in word:
+            if letter not in node.children:
+                node.children[letter] = FreqTreeNode()
+            node = node.children[letter]
+        node.value = freq
+
+    def __getitem__(self, item) -> int:
+        if not isinstance(item, str):
+            return 0
+        node = self
+        for letter in item:
+            if letter in node.children:
+                node = node.children[letter]
+            elif letter.upper() in node.children:
+                node = node.children[letter.upper()]
+            else:
+                return 0
+        return node.value
+
+    @instrument.timed("trie_feed")
+    def feed(self, freq_list: str, prefix: str = "", index: LETTER_INDEX = None) -> 'FreqTreeNode':
+        """Integrate all lines <segmentation word frequency> from frequency list into a tree. Adding can
+        be limited to words starting with given prefix. If letter index of the list is given, only blocks
+        of lines starting with the first letter of prefix are read."""
+        for values in read_freq_list(freq_list, prefix, index):
+            self.add(uppercase_format(values[0]), int(values[2]))
+        return self
+
+    def suffixes(self, prefix: str) -> Dict[str, int]:
+        """Returns all suffixes and their frequencies for given prefix."""
+        return dict(self.iter_suffixes(prefix))
+
+    def node_count(self) -> int:
+        """Returns number of nodes in the tree."""
+        count = 0
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            count += 1
+            nodes.extend(node.children.values())
+        return count
+
+    def iter_suffixes(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        """Yields pairs (suffix, frequency) of words starting with given prefix (in lowercase or as start of
+        segment), where suffix starts a new segment. Traverses the tree without recursion."""
+        nodes = [self]
+        for letter in prefix:
+            upper = letter.upper()
+            following = []
+            for node in nodes:
+                if letter in node.children:
+                    following.append(node.children[letter])
+                if upper != letter and upper in node.children:
+                    following.append(node.children[upper])
+            nodes = following
+        for start in nodes:
+            if not start.children or start.value != 0:
+                yield "", start.value
+            path = []
+            stack = [(node, 0, letter.lower()) for letter, node in reversed(start.children.items())
+                     if not letter.islower()]
+            while stack:
+                node, depth, letter = stack.pop()
+                del path[depth:]
+                path.append(letter)
+                if not node.children or node.value != 0:
+                    yield "".join(path), node.value
+                for letter, child in reversed(node.children.items()):
+                    stack.append((child, depth + 1, letter.lower()))
+
+
+TREE_INDEX_MAGIC = b"FQTR"
+TREE_INDEX_VERSION = 2
+
+
+class CompactFreqTree:
+    """Frequency list tree stored in flat integer arrays instead of node objects. While words are being added,
+    children of each node form a linked list (arrays child and sibling). Before the first query, the tree is
+    frozen: nodes are renumbered in breadth-first order, so that children of node i are nodes first[i] to
+    first[i + 1] - 1, sorted by their labels (character codes). Frozen tree can be saved to an index file
+    and memory-mapped back."""
+    def __init__(self):
+        self.labels = array("I", [0])
+        self.values = array("q", [0])
+        self.child = array("I", [0])
+        self.sibling = array("I", [0])
+        self.first = array("I")
+        self.frozen = False
+
+    def __len__(self) -> int:
+        """Returns number of nodes in the tree."""
+        return len(self.labels)
+
+    def node_count(self) -> int:
+        """Returns number of nodes in the tree (as FreqTreeNode.node_count)."""
+        return len(self)
+
+    def add(self, word: str, freq: int):
+        """Integrate word and its frequency into a tree."""
+        if self.frozen:
+            self.thaw()
+        node = 0
+        for letter in word:
+            label = ord(letter)
+            child = self.child[node]
+            while child and self.labels[child] != label:
+                child = self.sibling[child]
+            if not child:
+                child = len(self.labels)
+                self.labels.append(label)
+                self.values.append(0)
+                self.child.append(0)
+                self.sibling.append(self.child[node])
+                self.child[node] = child
+            node = child
+        self.values[node] = freq
+
+    def freeze(self) -> 'CompactFreqTree':
+        """Renumbers the nodes in breadth-first order with sorted children, which allows binary search
+        of a child."""
+        if self.frozen:
+            return self
+        order = array("I", [0])
+        labels, values, first = array("I", [0]), array("q", [self.values[0]]), array("I")
+        i = 0
+        while i < len(order):
+            first.append(len(order))
+            children = []
+            child = self.child[order[i]]
+            while child:
+                children.append((self.labels[child], child))
+                child = self.sibling[child]
+            children.sort()
+            for label, child in children:
+                order.append(child)
+                labels.append(label)
+                values.append(self.values[child])
+            i += 1
+        first.append(len(order))
+        self.labels, self.values, self.first = labels, values, first
+        self.child, self.sibling = array("I"), array("I")
+        self.frozen = True
+        return self
+
+    def thaw(self) -> None:
+        """Converts frozen tree back to linked lists of children, so that new words can be added."""
+        size = len(self.labels)
+        self.labels, self.values = array("I", self.labels), array("q", self.values)
+        self.child, self.sibling = array("I", bytes(4 * size)), array("I", bytes(4 * size))
+        for node in range(size):
+            start, end = self.first[node], self.first[node + 1]
+            if start < end:
+                self.child[node] = start
+                for i in range(start, end - 1):
+                    self.sibling[i] = i + 1
+        self.first = array("I")
+        self.frozen = False
+
+    def save(self, index_file: str) -> None:
+        """Stores frozen tree to binary index file (header, labels, first, values; native byte order)."""
+        import struct
+        self.freeze()
+        with open(index_file, "wb") as out:
+            out.write(struct.pack("=4sIQ", TREE_INDEX_MAGIC, TREE_INDEX_VERSION, len(self.labels)))
+            out.write(memoryview(self.labels).cast("B"))
+            out.write(memoryview(self.first).cast("B"))
+            out.write(bytes(-out.tell() % 8))
+            out.write(memoryview(self.values).cast("B"))
+
+    @classmethod
+    @instrument.timed("trie_load")
+    def load(cls, index_file: str) -> 'CompactFreqTree':
+        """Maps tree from binary index file into memory. Queries read the mapped pages directly, so the file
+        is shared via page cache among all processes using it."""
+        import mmap
+        import struct
+        tree = cls()
+        with open(index_file, "rb") as f:
+            tree.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = struct.unpack_from("=4sIQ", tree.map)
+        if magic != TREE_INDEX_MAGIC or version != TREE_INDEX_VERSION:
+            raise ValueError(f"{index_file}: not a frequency tree index of version {TREE_INDEX_VERSION}")
+        view = memoryview(tree.map)
+        offset = struct.calcsize("=4sIQ")
+        tree.labels = view[offset:offset + 4 * size].cast("I")
+        offset += 4 * size
+        tree.first = view[offset:offset + 4 * (size + 1)].cast("I")
+        offset += 4 * (size + 1)
+        offset += -offset % 8
+        assert offset % 8 == 0 and offset + 8 * size <= len(tree.map), f"{index_file}: misaligned values"
+        tree.values = view[offset:offset + 8 * size].cast("q")
+        tree.child, tree.sibling = array("I"), array("I")
+        tree.frozen = True
+        return tree
+
+    def find_child(self, node: int, letter: str) -> int:
+        """Returns index of the child of given node labelled with letter, or -1 if there is no such child."""
+        start, end = self.first[node], self.first[node + 1]
+        label = ord(letter)
+        i = bisect_left(self.labels, label, start, end)
+        if i < end and self.labels[i] == label:
+            return i
+        return -1
 
     def __getitem__(self, item) -> int:
         if not isinstance(item, str):
             return 0
-        if not item:
-            return self.value
-        if item[0] in self.children.keys():
-            return self.children[item[0]].__getitem__(item[1:])
-        elif item[0].upper() in self.children.keys():
-            return self.children[item[0].upper()].__getitem__(item[1:])
-        return 0
-
-    def feed(self, freq_list: str, prefix: str = "") -> 'FreqTreeNode':
+        self.freeze()
+        node = 0
+        for letter in item:
+            child = self.find_child(node, letter)
+            if child == -1:
+                child = self.find_child(node, letter.upper())
+            if child == -1:
+                return 0
+            node = child
+        return self.values[node]
+
+    @instrument.timed("trie_feed")
+    def feed(self, freq_list: str, prefix: str = "", index: LETTER_INDEX = None) -> 'CompactFreqTree':
         """Integrate all lines <segmentation word frequency> from frequency list into a tree. Adding can
-        be limited to words starting with given prefix."""
+        be limited to words starting with given prefix. If letter index of the list is given, only blocks
+        of lines starting with the first letter of prefix are read."""
+        for values in read_freq_list(freq_list, prefix, index):
+            self.add(uppercase_format(values[0]), int(values[2]))
+        return self.freeze()
+
+    def suffixes(self, prefix: str) -> Dict[str, int]:
+        """Returns all suffixes and their frequencies for given prefix."""
+        return dict(self.iter_suffixes(prefix))
+
+    def iter_suffixes(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        """Yields pairs (suffix, frequency) of words starting with given prefix (in lowercase or as start of
+        segment), where suffix starts a new segment."""
+        self.freeze()
+        nodes = [0]
+        for letter in prefix:
+            upper = letter.upper()
+            following = []
+            for node in nodes:
+                child = self.find_child(node, letter)
+                if child != -1:
+                    following.append(child)
+                child = self.find_child(node, upper) if upper != letter else -1
+                if child != -1:
+                    following.append(child)
+            nodes = following
+        labels, values, first = self.labels, self.values, self.first
+        for start in nodes:
+            if first[start] == first[start + 1] or values[start] != 0:
+                yield "", values[start]
+            path = []
+            stack = [(child, 0) for child in range(first[start + 1] - 1, first[start] - 1, -1)
+                     if not chr(labels[child]).islower()]
+            while stack:
+                node, depth = stack.pop()
+                del path[depth:]
+                path.append(chr(labels[node]).lower())
+                if first[node] == first[node + 1] or values[node] != 0:
+                    yield "".join(path), values[node]
+                for child in range(first[node + 1] - 1, first[node] - 1, -1):
+                    stack.append((child, depth + 1))
+
+
+class FreqTreeLoader:
+    """Supplies frequency list trees for segmented words. By default, only the tree of words starting with
+    the same letter as the last queried word is kept and it is rebuilt whenever the letter changes. If whole
+    is set, the whole frequency list is loaded into compact tree at once. Suffix distributions of the current
+    tree are kept in cache."""
+    def __init__(self, freq_list: str, whole: bool = False, debug: bool = False):
+        self.freq_list = freq_list
+        self.whole = whole
+        self.debug = debug
+        self.start_letter = None
+        self.tree = None
+        self.index = None
+        self.cache = SuffixCache()
+
+    def slice_key(self, segments: str) -> str:
+        """Returns key of the tree which tree_for returns for given segmented word, words with the same key
+        share the tree."""
+        return "" if self.whole else segments[:1]
+
+    def tree_for(self, segments: str):
+        """Returns tree containing all words starting with the same letter as given segmented word."""
+        if self.whole:
+            if self.tree is None:
+                if tree_index_current(self.freq_list):
+                    if self.debug:
+                        print("Mapping compact suffix tree index...", file=stderr)
+                    self.tree = CompactFreqTree.load(f"{self.freq_list}.trie")
+                else:
+                    if self.debug:
+                        print("Building compact suffix tree...", file=stderr)
+                    self.tree = CompactFreqTree().feed(self.freq_list)
+                instrument.count("trie_nodes", len(self.tree))
+            return self.tree
+        if segments[0] != self.start_letter:
+            self.start_letter = segments[0]
+            if self.debug:
+                print(f"Building suffix tree for prefix \'{self.start_letter}\'...", file=stderr)
+            if self.index is None:
+                self.index = letter_index(self.freq_list)
+            self.tree = FreqTreeNode().feed(self.freq_list, self.start_letter, self.index)
+            if instrument.ENABLED:
+                instrument.count("trie_nodes", self.tree.node_count())
+            self.cache.clear()
+        return self.tree
+
+
+def read_freq_list(freq_list: str, prefix: str = "", index: LETTER_INDEX = None) -> Iterator[List[str]]:
+    """Yields split lines <segmentation word frequency> of segmented frequency list whose words start with given
+    prefix. If letter index is given, only blocks of lines starting with the first letter of prefix are read."""
+    if index is None or not prefix:
         with open(freq_list, encoding="utf-8") as fl:
             for line in fl:
                 values = line.strip().split()
                 if values[1].startswith(prefix):
-                    self.add(uppercase_format(values[0]), int(values[2]))
-        return self
-
-    def suffixes(self, prefix: str, suffix: str = "") -> Dict[str, int]:
-        """Returns all suffixes and their frequencies for given prefix. Suffix is auxiliary parameter
-        used in recursion."""
-        suffixes = dict()
-        if prefix:
-            if prefix[0] in self.children.keys():
-                suffixes.update(self.children[prefix[0]].suffixes(prefix[1:]))
-            if prefix[0].upper() in self.children.keys():
-                suffixes.update(self.children[prefix[0].upper()].suffixes(prefix[1:]))
-            return suffixes
-        if not self.children:
-            return {suffix: self.value}
-        if self.value != 0:
-            suffixes[suffix] = self.value
-        for letter, node in self.children.items():
-            if not suffix and letter.islower():
-                continue
-            suffixes.update(node.suffixes(prefix, suffix + letter.lower()))
-        return suffixes
+                    yield values
+        return
+    with open(freq_list, "rb") as fl:
+        for start, end in index.get(prefix[0], []):
+            fl.seek(start)
+            while start < end:
+                line = fl.readline()
+                start += len(line)
+                values = line.decode("utf-8").strip().split()
+                if values[1].startswith(prefix):
+                    yield values
+
+
+def letter_index(freq_list: str) -> Dict[str, List[Tuple[int, int]]]:
+    """Returns byte ranges of blocks of lines whose words (second column) start with the same letter, for each
+    letter. The list needs to be sorted only roughly, a letter may have more blocks. Index is cached in
+    <freq_list>.letters file and rebuilt when the list is newer. The file is written under a temporary name
+    and renamed, so concurrent readers never see it incomplete."""
+    import os
+    from os import path
+    index_file = f"{freq_list}.letters"
+    index = dict()
+    if path.exists(index_file) and path.getmtime(index_file) >= path.getmtime(freq_list):
+        with open(index_file, encoding="utf-8") as f:
+            for line in f:
+                letter, start, end = line.rstrip("\n").split("\t")
+                index.setdefault(letter, []).append((int(start), int(end)))
+        return index
+    letter, start, offset = "", 0, 0
+    with open(freq_list, "rb") as fl:
+        for line in fl:
+            current = line.split()[1].decode("utf-8")[0]
+            if current != letter:
+                if offset > start:
+                    index.setdefault(letter, []).append((start, offset))
+                letter, start = current, offset
+            offset += len(line)
+    if offset > start:
+        index.setdefault(letter, []).append((start, offset))
+    with open(f"{index_file}.{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+        for letter, blocks in index.items():
+            for start, end in blocks:
+                print(f"{letter}\t{start}\t{end}", file=f)
+    os.replace(f"{index_file}.{os.getpid()}.tmp", index_file)
+    return index
+
+
+def build_tree_index(freq_list: str) -> None:
+    """Builds compact tree from segmented frequency list and stores it to <freq_list>.trie index file."""
+    CompactFreqTree().feed(freq_list).save(f"{freq_list}.trie")
+
+
+def tree_index_current(freq_list: str) -> bool:
+    """Checks whether index file of given segmented frequency list exists, is not older than the list and has
+    the current format version."""
+    import struct
+    from os import path
+    index_file = f"{freq_list}.trie"
+    if not path.exists(index_file) or path.getmtime(index_file) < path.getmtime(freq_list):
+        return False
+    with open(index_file, "rb") as f:
+        header = f.read(struct.calcsize("=4sI"))
+    return header == struct.pack("=4sI", TREE_INDEX_MAGIC, TREE_INDEX_VERSION)
 
 
 def uppercase_format(segmentation: str):
@@ -93,45 +433,83 @@ def clean_freqlist(freq_list: str) -> None:
     cleaned.close()
 
 
-def filter_freqlist(freq_list: str, all_forms: str) -> None:
-    """Picks from alphabetically sorted frequency list only forms of words in morphological database."""
-    out = open(f"{freq_list}.filtered", "w", encoding="utf-8")
-    forms = open(all_forms, encoding="utf-8")
-    form = forms.readline()
-    with open(freq_list, encoding="utf-8") as fl:
-        for line in fl:
-            if not form:
-                break
-            print(line.strip())  # debug
+def filter_freqlist(freq_list: str, all_forms: str = "", morph_db: md.MorphDatabase = None,
+                    progress: int = 1000000) -> None:
+    """Picks from alphabetically sorted frequency list only forms of words in morphological database. Forms are
+    merge-joined from file all_forms sorted the same way, or looked up directly in morph_db if it is given.
+    The merge compares words by code point, so both modes give the same output only if frequency list and forms
+    file are sorted by code point (sort with LC_ALL=C); under other collations the merge misses forms, while
+    the lookup does not depend on order of the list. Output is written in blocks, progress is reported
+    to stderr every progress lines."""
+    with open(freq_list, encoding="utf-8") as fl, \
+            open(f"{freq_list}.filtered", "w", encoding="utf-8", buffering=1 << 20) as out:
+        joined = merge_forms(fl, all_forms) if morph_db is None else lookup_forms(fl, morph_db)
+        block = []
+        for i, (line, sources) in enumerate(joined, 1):
+            for lemma, paradigm in sources:
+                block.append(f"{paradigm}\t{lemma}\t{line}")
+            if len(block) >= 65536:
+                out.write("".join(block))
+                block.clear()
+            if progress and i % progress == 0:
+                print(f"{freq_list}: {i} lines filtered", file=stderr)
+        out.write("".join(block))
+
+
+def merge_forms(lines: Iterable[str], all_forms: str) -> Iterator[Tuple[str, List[Tuple[str, str]]]]:
+    """Yields lines of sorted frequency list with pairs (lemma, paradigm) of matching lines <form:lemma:paradigm>
+    of sorted forms file. Both files are expected sorted by code point. Stops when forms file is exhausted."""
+    with open(all_forms, encoding="utf-8") as forms:
+        form = forms.readline()
+        if not form:
+            return
+        data = form.strip().split(":")
+        for line in lines:
             word = line.split()[0]
-            data = form.strip().split(":")
-            if str_gt(data[0], word):
-                continue
-            while str_gt(word, data[0]):
+            while data[0] < word:
                 form = forms.readline()
                 if not form:
-                    break
+                    return
                 data = form.strip().split(":")
+            sources = []
             while data[0] == word:
-                out.write(f"{data[2]}\t{data[1]}\t{line}")
+                sources.append((data[1], data[2]))
                 form = forms.readline()
                 if not form:
-                    break
+                    yield line, sources
+                    return
                 data = form.strip().split(":")
-    out.close()
-    forms.close()
+            yield line, sources
 
 
-def str_gt(this: str, other: str) -> bool:
-    """Compares two strings. Returns this >= other with respect to Unicode order."""
-    if this == other:
-        return False
-    for i in range(min(len(this), len(other))):
-        if this[i] > other[i]:
-            return True
-        elif this[i] < other[i]:
-            return False
-    return len(this) > len(other)
+def lookup_forms(lines: Iterable[str], morph_db: md.MorphDatabase) -> Iterator[Tuple[str, List[Tuple[str, str]]]]:
+    """Yields lines of frequency list with pairs (lemma, paradigm) producing their words in morph_db, ordered
+    as in forms file created by dic_file_all_forms and sorted by sort -f."""
+    forms = forms_sources(morph_db)
+    for line in lines:
+        yield line, forms.get(line.split()[0], [])
+
+
+def forms_sources(morph_db: md.MorphDatabase,
+                  entries: Set[Tuple[str, str]] = None) -> Dict[str, List[Tuple[str, str]]]:
+    """Returns all forms of vocabulary of morph_db (or only of its given entries) with pairs (lemma, paradigm)
+    producing them, in order of forms file lines."""
+    forms = dict()
+    for lemma, paradigm in morph_db.vocab:
+        if entries is not None and (lemma, paradigm) not in entries:
+            continue
+        for form in morph_db.lemma_forms(lemma, paradigm):
+            forms.setdefault(form, []).append((lemma, paradigm))
+    for sources in forms.values():
+        sources.sort(key=source_order)
+    return forms
+
+
+def source_order(entry: Tuple[str, str]) -> Tuple[str, str]:
+    """Returns sorting key of pair (lemma, paradigm) matching order of forms file lines with the same form
+    sorted by sort -f."""
+    line = f"{entry[0]}:{entry[1]}"
+    return line.upper(), line
 
 
 def segment_dic_file(morph_db: md.MorphDatabase, seg_method, outfile: str, only_lemmas: bool = True) -> None:
@@ -148,6 +526,8 @@ def segment_dic_file(morph_db: md.MorphDatabase, seg_method, outfile: str, only_
                 segments = "=".join(seg_method(form)).replace("_", "").replace("¦", "").replace("𐋇", "") \
                     .replace("𐊣", "").replace("𐊼", "")
                 print(f"{segments}:{lemma}:{paradigm}", file=out)
+    if hasattr(seg_method, "flush"):
+        seg_method.flush()
 
 
 def normalize_spread(spread: Dict[str, float]) -> Dict[str, float]:
@@ -160,36 +540,225 @@ def normalize_spread(spread: Dict[str, float]) -> Dict[str, float]:
     return {suf: freq / norm for (suf, freq) in spread.items()}
 
 
+class SpreadMatrix:
+    """Paradigm x suffix matrices of normalized paradigm spreads and of suffixes present in the spreads, which
+    allow to score all candidate paradigms of a word with few NumPy operations. Rows follow
+    morph_db.paradigm_ids and columns morph_db.suffix_ids. Scores equal to scoring_comm_square_spread_suf
+    (up to floating point rounding)."""
+    def __init__(self, morph_db: md.MorphDatabase):
+        import numpy as np
+        self.morph_db = morph_db
+        self.rows = {paradigm: i for i, paradigm in enumerate(morph_db.paradigm_ids)}
+        self.spreads = np.zeros((len(morph_db.paradigm_ids), len(morph_db.suffix_ids)))
+        self.present = np.zeros(self.spreads.shape, dtype=bool)
+        self.squares = np.zeros(len(morph_db.paradigm_ids))
+        for paradigm in morph_db.paradigm_ids:
+            self.update_row(paradigm)
+
+    def update_row(self, paradigm: str) -> None:
+        """Recomputes normalized spread of given paradigm from the database."""
+        row = self.rows[paradigm]
+        self.spreads[row] = 0.0
+        self.present[row] = False
+        for suffix, freq in normalize_spread(self.morph_db.paradigms[paradigm].get("spread", dict())).items():
+            self.spreads[row, self.morph_db.suffix_ids[suffix]] = freq
+            self.present[row, self.morph_db.suffix_ids[suffix]] = True
+        self.squares[row] = (self.spreads[row] ** 2).sum()
+
+    def scores(self, paradigms: List[str], common_forms: List[int], guess_normed: Dict[str, float],
+               len_suffix: int, spread_delta: SPREAD_DELTA = None):
+        """Returns array of scores of given paradigms having given numbers of common forms with a word, whose
+        normalized spread is guess_normed. Paradigms with spread changed by spread_delta are scored separately."""
+        import numpy as np
+        rows = np.array([self.rows[paradigm] for paradigm in paradigms], dtype=int)
+        known = [(self.morph_db.suffix_ids[suf], freq) for suf, freq in guess_normed.items()
+                 if suf in self.morph_db.suffix_ids]
+        diff = self.squares[rows]
+        if known:
+            columns = np.array([column for column, _ in known], dtype=int)
+            freqs = np.array([freq for _, freq in known])
+            mesh = np.ix_(rows, columns)
+            diff = diff - 2 * (self.spreads[mesh] @ freqs) + self.present[mesh] @ (freqs ** 2)
+        if spread_delta:
+            diff = diff.copy()
+            for i, paradigm in enumerate(paradigms):
+                if paradigm in spread_delta:
+                    diff[i] = square_spread_difference(
+                        normalize_spread(paradigm_spread(self.morph_db, paradigm, spread_delta)), guess_normed)
+        return ((len_suffix + 2) / (len_suffix + 1)) * (np.array(common_forms) - diff)
+
+
+class SuffixDistribution:
+    """Suffixes following a prefix in frequency tree with their frequencies, also as a set and as normalized
+    spread (computed on first use)."""
+    __slots__ = ("tree", "suffixes", "keys", "normed_spread")
+
+    def __init__(self, tree, suffixes: Dict[str, int]):
+        self.tree = tree
+        self.suffixes = suffixes
+        self.keys = set(suffixes.keys())
+        self.normed_spread = None
+
+    def normed(self) -> Dict[str, float]:
+        """Returns normalized spread of the suffixes."""
+        if self.normed_spread is None:
+            self.normed_spread = normalize_spread(self.suffixes)
+        return self.normed_spread
+
+
+class SuffixCache:
+    """Bounded LRU cache of suffix distributions keyed by prefix and identity of frequency tree. Counts hits
+    and misses. Should be cleared whenever the tree is replaced."""
+    def __init__(self, size: int = 4096):
+        from collections import OrderedDict
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tree, prefix: str) -> SuffixDistribution:
+        """Returns suffix distribution of given prefix in given tree."""
+        key = (id(tree), prefix)
+        distribution = self.entries.get(key)
+        if distribution is not None and distribution.tree is tree:
+            self.hits += 1
+            if instrument.ENABLED:
+                instrument.count("cache_hits")
+            self.entries.move_to_end(key)
+            return distribution
+        self.misses += 1
+        if instrument.ENABLED:
+            with instrument.stage("suffixes"):
+                distribution = SuffixDistribution(tree, tree.suffixes(prefix))
+        else:
+            distribution = SuffixDistribution(tree, tree.suffixes(prefix))
+        if self.size > 0:
+            self.entries[key] = distribution
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return distribution
+
+    def clear(self) -> None:
+        """Removes all cached distributions."""
+        self.entries.clear()
+
+    def __str__(self):
+        return f"suffix cache: {self.hits} hits, {self.misses} misses, {len(self.entries)}/{self.size} entries"
+
+
+def paradigm_spread(morph_db: md.MorphDatabase, paradigm: str, spread_delta: SPREAD_DELTA = None) -> Dict[str, int]:
+    """Returns absolute spread of given paradigm with changes from spread_delta (paradigm: suffix: change) applied.
+    Spread in database is left untouched."""
+    spread = morph_db.paradigms[paradigm].get("spread", dict())
+    if not spread_delta or paradigm not in spread_delta:
+        return spread
+    spread = dict(spread)
+    for suffix, change in spread_delta[paradigm].items():
+        spread[suffix] = spread.get(suffix, 0) + change
+    return spread
+
+
 def tree_spread_scores(segments: str, tree: FreqTreeNode, morph_db: md.MorphDatabase, scoring,
-                       only_lemmas: bool = False) -> Dict[str, float]:
-    """Computes paradigm scores for given word based on its forms spread."""
+                       only_lemmas: bool = False, matrix: SpreadMatrix = None,
+                       spread_delta: SPREAD_DELTA = None, cache: 'SuffixCache' = None) -> Dict[str, float]:
+    """Computes paradigm scores for given word based on its forms spread. If spread matrix is given, it is used
+    for scoring instead of scoring function. Paradigm spreads can be altered for this query by spread_delta
+    (e.g. to exclude the word itself), the database is not modified. Suffix distributions of prefixes are taken
+    from cache, if given."""
+    n_most_common, normed = spread_candidates(segments, tree, morph_db, only_lemmas, cache)
+    if not instrument.ENABLED:
+        return spread_scores(segments, n_most_common, normed, morph_db, scoring, matrix, spread_delta)
+    with instrument.stage("scoring"):
+        return spread_scores(segments, n_most_common, normed, morph_db, scoring, matrix, spread_delta)
+
+
+def spread_scores(segments: str, n_most_common: Dict[str, Tuple[int, str]], normed: Dict[str, Dict[str, float]],
+                  morph_db: md.MorphDatabase, scoring, matrix: SpreadMatrix = None,
+                  spread_delta: SPREAD_DELTA = None) -> Dict[str, float]:
+    """Scores candidate paradigms of given word found by spread_candidates."""
     scores = dict()
+    if matrix is not None:
+        by_prefix = dict()
+        for paradigm, (common, prefix) in n_most_common.items():
+            by_prefix.setdefault(prefix, []).append((paradigm, common))
+        for prefix, candidates in by_prefix.items():
+            paradigms = [paradigm for paradigm, _ in candidates]
+            prefix_scores = matrix.scores(paradigms, [common for _, common in candidates], normed[prefix],
+                                          len(segments) - len(prefix), spread_delta)
+            scores.update(zip(paradigms, prefix_scores.tolist()))
+        return scores
+    for paradigm, (common, prefix) in n_most_common.items():
+        scores[paradigm] = scoring(common,
+                                   normed[prefix],
+                                   normalize_spread(paradigm_spread(morph_db, paradigm, spread_delta)),
+                                   (len(segments) - len(prefix))
+                                   )
+    return scores
+
+
+def spread_candidates(segments: str, tree: FreqTreeNode, morph_db: md.MorphDatabase, only_lemmas: bool = False,
+                      cache: 'SuffixCache' = None) -> Tuple[Dict[str, Tuple[int, str]], Dict[str, Dict[str, float]]]:
+    """Returns candidate paradigms of given word with their greatest number of common forms and the prefix of
+    the word it was reached with, and normalized suffix distributions of these prefixes."""
     n_most_common = dict()
     normed = dict()
     prefix_frequencies = dict()
-    all_suffixes = morph_db.all_suffixes()
-    for i in range(len(segments)):
-        if segments[i].islower():
-            continue
-        prefix = segments[:i].lower()
-        if segments[len(prefix):].lower() in all_suffixes:
-            prefix_frequencies[prefix] = tree.suffixes(prefix)
-    prefix_frequencies[segments.lower()] = tree.suffixes(segments.lower())
-    for prefix, word_suffixes in prefix_frequencies.items():
+    if cache is None:
+        cache = SuffixCache(0)
+    for i in morph_db.suffix_boundaries(segments.lower()):
+        if not segments[i].islower():
+            prefix = segments[:i].lower()
+            prefix_frequencies[prefix] = cache.get(tree, prefix)
+    prefix_frequencies[segments.lower()] = cache.get(tree, segments.lower())
+    for prefix, distribution in prefix_frequencies.items():
         suffix = segments[len(prefix):].lower()
-        n_best = n_best_paradigms(set(word_suffixes.keys()), morph_db, suffix, only_lemmas=only_lemmas)
+        if instrument.ENABLED:
+            with instrument.stage("n_best_paradigms"):
+                n_best = n_best_paradigms(distribution.keys, morph_db, suffix, only_lemmas=only_lemmas)
+        else:
+            n_best = n_best_paradigms(distribution.keys, morph_db, suffix, only_lemmas=only_lemmas)
         for (common, paradigm) in n_best:
             if n_most_common.get(paradigm, (0, ""))[0] < common:
                 if prefix not in normed.keys():
-                    normed[prefix] = normalize_spread(word_suffixes)
+                    normed[prefix] = distribution.normed()
                 n_most_common[paradigm] = (common, prefix)
+    if instrument.ENABLED:
+        instrument.count("words")
+        instrument.count("candidates", len(n_most_common))
+    return n_most_common, normed
+
+
+def best_spread_scores(segments: str, tree: FreqTreeNode, morph_db: md.MorphDatabase, k: int = 5,
+                       threshold: float = float("-inf"), only_lemmas: bool = False,
+                       cache: 'SuffixCache' = None) -> List[Tuple[float, str]]:
+    """Returns k best pairs (score, paradigm) by scoring_comm_square_spread_suf in descending order, the same as
+    the beginning of sorted scores of tree_spread_scores. Candidates are scored in descending order of their
+    upper bound (len_suffix + 2) / (len_suffix + 1) * common_forms and scoring stops once no other candidate
+    can get among k best. Returns empty list if no candidate scores above threshold, without scoring any if
+    none of their upper bounds is above it."""
+    from heapq import heappush, heapreplace
+    n_most_common, normed = spread_candidates(segments, tree, morph_db, only_lemmas, cache)
+    bounds = []
     for paradigm, (common, prefix) in n_most_common.items():
-        scores[paradigm] = scoring(common,
-                                   normed[prefix],
-                                   normalize_spread(morph_db.paradigms[paradigm].get("spread", dict())),
-                                   (len(segments) - len(prefix))
-                                   )
-    return scores
+        len_suffix = len(segments) - len(prefix)
+        bounds.append((((len_suffix + 2) / (len_suffix + 1)) * common, paradigm))
+    bounds.sort(reverse=True)
+    if not bounds or bounds[0][0] <= threshold:
+        return []
+    best = []
+    for bound, paradigm in bounds:
+        if len(best) == k and bound < best[0][0]:
+            break
+        common, prefix = n_most_common[paradigm]
+        score = (scoring_comm_square_spread_suf(common, normed[prefix],
+                                                normalize_spread(paradigm_spread(morph_db, paradigm)),
+                                                len(segments) - len(prefix)), paradigm)
+        if len(best) < k:
+            heappush(best, score)
+        elif score > best[0]:
+            heapreplace(best, score)
+    best.sort(reverse=True)
+    return best if best[0][0] > threshold else []
 
 
 def scoring_comm_square_spread_suf(common_forms: int, guess_normed: Dict[str, float], par_normed: Dict[str, float], len_suffix: int):
@@ -206,19 +775,18 @@ def square_spread_difference(paradigm: Dict[str, float], word: Dict[str, float])
     return diff
 
 
-def n_best_paradigms(word_suffixes: Set[str], morph_db: md.MorphDatabase, suffix: str, n: int = 5,
+def n_best_paradigms(word_suffixes: Iterable[str], morph_db: md.MorphDatabase, suffix: str, n: int = 5,
                      only_lemmas: bool = False) -> List[Tuple[int, str]]:
     """Chooses n most suitable paradigms for given suffixes based on size of their intersection. Can return more than
-    n paradigms if they have the same score as the n-th one."""
+    n paradigms if they have the same score as the n-th one. Suffixes can be given as any iterable (e.g. suffixes
+    from iter_suffixes of frequency tree), they are read only once."""
     i_sizes = list()
-    for paradigm, data in morph_db.paradigms.items():
-        par_affixes = morph_db.affixes(paradigm)
-        if suffix not in par_affixes:
+    word_bits = morph_db.suffix_bits(word_suffixes)
+    for i in morph_db.suffix_paradigms.get(suffix, []):
+        if only_lemmas and suffix != morph_db.lemma_suffixes[i]:
             continue
-        if only_lemmas and suffix != data["<suffix>"].split("_")[0]:
-            continue
-        common = len(word_suffixes.intersection(par_affixes))
-        i_sizes.append((common, paradigm))
+        common = md.popcount(word_bits & morph_db.affix_bits[i])
+        i_sizes.append((common, morph_db.paradigm_ids[i]))
     nth_score = 1
     result = []
     for i, (score, paradigm) in enumerate(sorted(i_sizes, reverse=True)):
@@ -231,12 +799,96 @@ def n_best_paradigms(word_suffixes: Set[str], morph_db: md.MorphDatabase, suffix
 
 
 def segment_freq_list(freq_list: str, seg_method, suffix: str) -> None:
-    """Adds info about segmentation to frequency list and stores it."""
+    """Adds info about segmentation to frequency list and stores it. Segmentation method can be cached
+    (see guesser.cached_segment_method)."""
     outfile = open(f"{freq_list}.{suffix}", "w", encoding="utf-8")
     with open(freq_list, encoding="utf-8") as fl:
         for line in fl:
             print(f"{'='.join(seg_method(line.split()[0]))}\t{line.strip()}", file=outfile)
     outfile.close()
+    if hasattr(seg_method, "flush"):
+        seg_method.flush()
+
+
+SEGMENTER = dict()
+
+
+def segment_freq_list_parallel(freq_list: str, seg_tool: str, jobs: int = 4, chunk_size: int = 1 << 25) -> None:
+    """Adds info about segmentation to frequency list like segment_freq_list, but splits the list into chunks
+    of whole lines and segments them in a pool of processes, each loading segmentation model only once. The model
+    is trained (if not cached yet) before the pool starts, workers only load it.
+    Finished chunks are kept in <freq_list>.<seg_tool>.parts directory, so an interrupted run resumes with
+    the missing chunks only. Chunks are concatenated in order at the end."""
+    import os
+    import shutil
+    from multiprocessing import Pool
+    outfile = f"{freq_list}.{seg_tool}"
+    parts = f"{outfile}.parts"
+    chunks = chunk_bounds(freq_list, chunk_size)
+    plan = "\n".join([f"{os.path.getsize(freq_list)} {os.stat(freq_list).st_mtime_ns}"] +
+                     [f"{start} {end}" for start, end in chunks])
+    if os.path.exists(f"{parts}{os.sep}plan"):
+        with open(f"{parts}{os.sep}plan", encoding="utf-8") as f:
+            if f.read() != plan:
+                shutil.rmtree(parts)
+    os.makedirs(parts, exist_ok=True)
+    with open(f"{parts}{os.sep}plan", "w", encoding="utf-8") as f:
+        f.write(plan)
+    todo = [(freq_list, start, end, f"{parts}{os.sep}{i:06d}") for i, (start, end) in enumerate(chunks)
+            if not os.path.exists(f"{parts}{os.sep}{i:06d}")]
+    if todo:
+        import guesser
+        model = guesser.segment_model(seg_tool)
+        with Pool(jobs, initializer=init_segmenter, initargs=(seg_tool, model)) as pool:
+            for i, part in enumerate(pool.imap_unordered(segment_chunk, todo)):
+                print(f"{part}: done ({len(chunks) - len(todo) + i + 1}/{len(chunks)})", file=stderr)
+    with open(f"{outfile}.tmp", "wb") as out:
+        for i in range(len(chunks)):
+            with open(f"{parts}{os.sep}{i:06d}", "rb") as part:
+                shutil.copyfileobj(part, out)
+    os.replace(f"{outfile}.tmp", outfile)
+    shutil.rmtree(parts)
+
+
+def chunk_bounds(file: str, chunk_size: int) -> List[Tuple[int, int]]:
+    """Splits file into byte ranges of approximately chunk_size bytes, each consisting of whole lines."""
+    import os
+    size = os.path.getsize(file)
+    bounds = [0]
+    with open(file, "rb") as f:
+        while bounds[-1] + chunk_size < size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def init_segmenter(seg_tool: str, model: str = "") -> None:
+    """Loads segmentation method with given trained model in worker process."""
+    import guesser
+    SEGMENTER["method"] = guesser.cached_segment_method(seg_tool, model)
+
+
+def segment_chunk(chunk: Tuple[str, int, int, str]) -> str:
+    """Segments lines of frequency list in given byte range and stores them to part file. Part file appears only
+    after the whole chunk is done. Returns its name."""
+    import os
+    freq_list, start, end, part = chunk
+    seg_method = SEGMENTER["method"]
+    with open(freq_list, "rb") as fl:
+        fl.seek(start)
+        lines = fl.read(end - start).decode("utf-8").split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    with open(f"{part}.tmp", "w", encoding="utf-8") as out:
+        out.write("".join(f"{'='.join(seg_method(line.split()[0]))}\t{line.strip()}\n" for line in lines))
+    if hasattr(seg_method, "flush"):
+        seg_method.flush()
+    os.replace(f"{part}.tmp", part)
+    return part
 
 
 def test_forms(file: str = "data/current.dic.cleaned.utf8.sorted.forms", ratio: int = 50) -> None:
@@ -253,7 +905,9 @@ def test_forms(file: str = "data/current.dic.cleaned.utf8.sorted.forms", ratio:
 
 def print_scores(word: str, scores: Dict[str, float], outfile=stdout) -> None:
     """Prints paradigms in descending order (by their frequency scores)."""
-    print(word + ":", end="")
-    for paradigm, score in scores.items():
-        print(f" {paradigm} ({score})", end="", file=outfile)
-    print(file=outfile)
+    outfile.write(format_scores(word, scores))
+
+
+def format_scores(word: str, scores: Dict[str, float]) -> str:
+    """Returns line of print_scores output."""
+    return word + ":" + "".join(f" {paradigm} ({score})" for paradigm, score in scores.items()) + "\n"
@@ -1,57 +1,128 @@
 #!/usr/bin/env python3
 """This file contains tools for evaluating test logs with multiple metrics."""
-from typing import Tuple, List
+from typing import Iterator, Tuple, List
 from os import listdir
 from sys import stdout
 import morph_database as md
 
 
-def top_n_check(log_file: str, top_n: int = 1) -> Tuple[List[int], int, int]:
-    """Reads the given log file and evaluates its same_paradigm precision in
-    1 to <top_n> guesses. Returns (correct, all, total guesses)."""
-    correct = [0 for _ in range(top_n)]
-    entries, guess_count = 0, 0
+class TopNMetric:
+    """Counts entries with correct paradigm among 1 to <top_n> first guesses and all guesses (including one
+    padding guess)."""
+    def __init__(self, top_n: int = 1):
+        self.top_n = top_n
+        self.correct = [0 for _ in range(top_n)]
+        self.guess_count = 0
+
+    def add(self, form: str, paradigm: str, guesses: List[str]) -> None:
+        guesses = guesses + [max(self.top_n - len(guesses), 0) * "_"]
+        self.guess_count += len(guesses)
+        for i in range(self.top_n - 1, -1, -1):
+            if paradigm not in guesses[:i+1]:
+                break
+            self.correct[i] += 1
+
+
+class CriterionMetric:
+    """Counts entries whose first guess conforms to given (one of same_affixes, same_lemma, common_forms,
+    common_tags) criterion."""
+    def __init__(self, crit: str, morph_db: md.MorphDatabase, threshold: int = 5):
+        self.crit = crit
+        self.morph_db = morph_db
+        self.threshold = threshold
+        self.correct = 0
+
+    def add(self, form: str, paradigm: str, guesses: List[str]) -> None:
+        if not guesses:
+            return
+        if self.crit == "same_lemma":
+            if self.morph_db.same_lemma(form, guesses[0], paradigm):
+                self.correct += 1
+        elif self.morph_db.paradigm_comp(guesses[0], paradigm, self.crit, threshold=self.threshold):
+            self.correct += 1
+
+
+CRITERIA = ["same_affixes", "common_forms", "common_tags", "same_lemma"]
+
+
+def read_log(log_file: str) -> Iterator[Tuple[str, str, List[str]]]:
+    """Yields (form, correct paradigm, guessed paradigms) for each entry of given log file."""
     with open(log_file, encoding="utf-8") as log:
-        line = log.readline()
-        while line:
-            entries += 1
-            paradigm = line.strip().split(":")[-1]
-            guesses = log.readline().strip().split(", ")
+        for line in log:
+            data = line.strip().split(":")
+            guesses = next(log, "").strip().split(", ")
             if "" in guesses:
                 guesses.remove("")
-            guesses += [max(top_n - len(guesses), 0) * "_"]
-            guess_count += len(guesses)
-            for i in range(top_n - 1, -1, -1):
-                if paradigm not in guesses[:i+1]:
-                    break
-                correct[i] += 1
-            line = log.readline()
-    return correct, entries, guess_count
-
-
-def full_eval(fltr: str = "", top_n: int = 1, threshold: int = 5, debug: bool = False) -> None:
-    """Evaluates all log files with all metrics."""
-    morph_db = md.MorphDatabase("data/current.dic", "data/current.par")
+            yield data[0], data[-1], guesses
+
+
+def evaluate_log(log_file: str, metrics: list) -> Tuple[int, int]:
+    """Reads given log file once and feeds each entry to all metrics. Returns (entries, total guesses)."""
+    entries, guess_count = 0, 0
+    for form, paradigm, guesses in read_log(log_file):
+        entries += 1
+        guess_count += len(guesses)
+        for metric in metrics:
+            metric.add(form, paradigm, guesses)
+    return entries, guess_count
+
+
+def top_n_check(log_file: str, top_n: int = 1) -> Tuple[List[int], int, int]:
+    """Reads the given log file and evaluates its same_paradigm precision in
+    1 to <top_n> guesses. Returns (correct, all, total guesses)."""
+    metric = TopNMetric(top_n)
+    entries, _ = evaluate_log(log_file, [metric])
+    return metric.correct, entries, metric.guess_count
+
+
+def full_eval(fltr: str = "", top_n: int = 1, threshold: int = 5, debug: bool = False, jobs: int = 1) -> None:
+    """Evaluates all log files with all metrics, reading each log only once. With more jobs, logs are evaluated
+    in parallel processes."""
+    morph_db = md.load_database("data/current.dic", "data/current.par")
     outfile = stdout
     if not debug:
         import datetime
         outfile = open(f"results/{datetime.date.today()}_all.txt", "w", encoding="utf-8")
-    for log_file in listdir("logs"):
-        if fltr not in log_file:
-            continue
-        correct, entries, guess_count = top_n_check(f"logs/{log_file}", top_n)
-        print(f"{log_file}: {entries} examples, {round(guess_count / entries, 3)} guesses at average", file=outfile)
-        for i in range(len(correct)):
-            print(f"\tsame_paradigms_top_{i + 1}: {correct[i]} (precision {round(correct[i] / entries, 3)})",
-                  file=outfile)
-        for crit in ["same_affixes", "common_forms", "common_tags", "same_lemma"]:
-            correct, entries, guess_count = md_check(f"logs/{log_file}", crit, morph_db, threshold)
-            print(f"\t{crit}{f'_{threshold}' if crit == 'common_forms' else ''}: {correct} "
-                  f"(precision {round(correct / entries, 3)})", file=outfile)
+    log_files = [f"logs/{log_file}" for log_file in listdir("logs") if fltr in log_file]
+    if jobs > 1:
+        from multiprocessing import Pool
+        with Pool(jobs, initializer=init_worker, initargs=(morph_db, top_n, threshold)) as pool:
+            reports = pool.map(full_report, log_files, chunksize=1)
+    else:
+        init_worker(morph_db, top_n, threshold)
+        reports = map(full_report, log_files)
+    for report in reports:
+        outfile.write(report)
     if not debug:
         outfile.close()
 
 
+WORKER = dict()
+
+
+def init_worker(morph_db: md.MorphDatabase, top_n: int, threshold: int) -> None:
+    """Prepares database and evaluation parameters in current process."""
+    WORKER["morph_db"] = morph_db
+    WORKER["top_n"] = top_n
+    WORKER["threshold"] = threshold
+
+
+def full_report(log_file: str) -> str:
+    """Evaluates given log file with all metrics at once. Returns the report."""
+    top = TopNMetric(WORKER["top_n"])
+    criteria = [CriterionMetric(crit, WORKER["morph_db"], WORKER["threshold"]) for crit in CRITERIA]
+    entries, _ = evaluate_log(log_file, [top] + criteria)
+    report = [f"{log_file[len('logs/'):]}: {entries} examples, {round(top.guess_count / entries, 3)} "
+              f"guesses at average\n"]
+    for i in range(len(top.correct)):
+        report.append(f"\tsame_paradigms_top_{i + 1}: {top.correct[i]} "
+                      f"(precision {round(top.correct[i] / entries, 3)})\n")
+    for metric in criteria:
+        report.append(f"\t{metric.crit}{f'_{metric.threshold}' if metric.crit == 'common_forms' else ''}: "
+                      f"{metric.correct} (precision {round(metric.correct / entries, 3)})\n")
+    return "".join(report)
+
+
 def classic_eval(fltr: str = "", top_n: int = 1, debug: bool = False) -> None:
     """Evaluates all logs with same_paradigm metric."""
     outfile = stdout
@@ -72,7 +143,7 @@ def classic_eval(fltr: str = "", top_n: int = 1, debug: bool = False) -> None:
 def md_eval(crit: str, fltr: str = "", threshold: int = 5, debug: bool = False) -> None:
     """Evaluates all logs with given (one of same_affixes, same_lemma, common_forms,
     common_tags) metric."""
-    morph_db = md.MorphDatabase("data/current.dic", "data/current.par")
+    morph_db = md.load_database("data/current.dic", "data/current.par")
     outfile = stdout
     if not debug:
         import datetime
@@ -89,25 +160,9 @@ def md_eval(crit: str, fltr: str = "", threshold: int = 5, debug: bool = False)
 def md_check(log_file: str, crit: str, morph_db, threshold: int = 5) -> Tuple[int, int, int]:
     """Evaluates given log file with given (one of same_affixes, same_lemma, common_forms,
     common_tags) metric."""
-    correct = 0
-    entries, guess_count = 0, 0
-    with open(log_file, encoding="utf-8") as log:
-        line = log.readline()
-        while line:
-            entries += 1
-            paradigm = line.strip().split(":")[-1]
-            form = line.strip().split(":")[0]
-            guesses = log.readline().strip().split(", ")
-            if "" in guesses:
-                guesses.remove("")
-            guess_count += len(guesses)
-            if crit == "same_lemma":
-                if guesses and morph_db.same_lemma(form, guesses[0], paradigm):
-                    correct += 1
-            elif guesses and morph_db.paradigm_comp(guesses[0], paradigm, crit, threshold=threshold):
-                correct += 1
-            line = log.readline()
-    return correct, entries, guess_count
+    metric = CriterionMetric(crit, morph_db, threshold)
+    entries, guess_count = evaluate_log(log_file, [metric])
+    return metric.correct, entries, guess_count
 
 
 def main():
@@ -121,12 +176,13 @@ def main():
     parser.add_argument("-t", "--threshold", type=int, help="threshold for common_forms", default=5)
     parser.add_argument("-d", "--debug", action="store_true", help="print to standard output", default=False)
     parser.add_argument("-n", "--top_n", type=int, help="evaluate n best guesses", default=5)
+    parser.add_argument("-j", "--jobs", type=int, help="evaluate logs in given number of processes", default=1)
     args = parser.parse_args()
     start = time()
     if args.criterion == "same_paradigms":
         classic_eval(args.filter, args.top_n, args.debug)
     elif args.criterion == "all":
-        full_eval(args.filter, args.top_n, args.threshold, args.debug)
+        full_eval(args.filter, args.top_n, args.threshold, args.debug, args.jobs)
     else:
         md_eval(args.criterion, args.filter, args.threshold, args.debug)
     print(f"finished in {round(time() - start)}s")
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""This script runs a long-living paradigm guessing server. Morphological database and frequency tree are
+loaded only once, clients send JSON lines over Unix or TCP socket, e.g.
+{"id": 1, "words": ["prahou", "domečky"], "lemma": false, "top": 5} and obtain
+{"id": 1, "results": [{"word": "prahou", "paradigms": [{"paradigm": ..., "score": ..., "lemma": ...,
+"forms": [...]}, ...]}, ...]}. Requests arriving at the same time are answered in one batch."""
+import json
+import os
+import queue
+import socketserver
+import threading
+from sys import stderr
+from time import monotonic
+from typing import Any, Dict, List
+import db_stats as dbs
+import guesser as g
+import morph_database as md
+
+
+class GuessServer:
+    """Collects requests from client threads into batches, guesses paradigms in a single scoring thread and
+    hands the responses back."""
+    def __init__(self, morph_db: md.MorphDatabase, segment, trees: dbs.FreqTreeLoader,
+                 matrix: dbs.SpreadMatrix = None, batch_wait: float = 0.005, batch_words: int = 512):
+        self.morph_db = morph_db
+        self.segment = segment
+        self.trees = trees
+        self.matrix = matrix
+        self.batch_wait = batch_wait
+        self.batch_words = batch_words
+        self.requests = queue.Queue()
+        threading.Thread(target=self.serve_batches, daemon=True).start()
+
+    def submit(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Puts request into the queue and waits for its response."""
+        slot = {"request": request, "done": threading.Event()}
+        self.requests.put(slot)
+        slot["done"].wait()
+        return slot["response"]
+
+    def serve_batches(self) -> None:
+        """Takes requests from the queue, waiting at most batch_wait seconds for more requests to join
+        the first one, and answers them together. A failure of the batch is answered as error of its requests
+        which are not answered yet, the thread keeps serving."""
+        while True:
+            batch = [self.requests.get()]
+            words = len(request_words(batch[0]["request"]))
+            deadline = monotonic() + self.batch_wait
+            while words < self.batch_words:
+                try:
+                    batch.append(self.requests.get(timeout=max(0.0, deadline - monotonic())))
+                except queue.Empty:
+                    break
+                words += len(request_words(batch[-1]["request"]))
+            try:
+                self.answer(batch)
+            except Exception as e:
+                for slot in batch:
+                    if not slot["done"].is_set():
+                        slot["response"] = {"id": slot["request"].get("id"), "error": f"{type(e).__name__}: {e}"}
+                        slot["done"].set()
+
+    def answer(self, batch: List[Dict[str, Any]]) -> None:
+        """Guesses paradigms for all words in batch of requests, each distinct word only once."""
+        guessed = dict()
+        for slot in batch:
+            request = slot["request"]
+            try:
+                only_lemmas = bool(request.get("lemma", False))
+                top_n = int(request.get("top", 5))
+                results = []
+                for word in request_words(request):
+                    if (word, only_lemmas) not in guessed:
+                        guessed[(word, only_lemmas)] = self.guess(word, only_lemmas)
+                    results.append({"word": word, "paradigms": guessed[(word, only_lemmas)][:top_n]})
+                slot["response"] = {"id": request.get("id"), "results": results}
+            except Exception as e:
+                slot["response"] = {"id": request.get("id"), "error": f"{type(e).__name__}: {e}"}
+            slot["done"].set()
+        try:
+            g.flush_segmentations(self.segment)
+        except Exception as e:
+            print(f"storing segmentations failed (kept for next batch): {type(e).__name__}: {e}", file=stderr)
+
+    def guess(self, word: str, only_lemmas: bool = False) -> List[Dict[str, Any]]:
+        """Returns guessed paradigms of a word with their scores, lemmas and forms, best first."""
+        if not word.strip():
+            return []
+        segments = dbs.uppercase_format("=".join(self.segment(word.strip().lower())))
+        scores = g.tree_guess_paradigm_from_corpus(segments, self.trees.tree_for(segments), self.morph_db,
+                                                   dbs.scoring_comm_square_spread_suf, only_lemmas, self.matrix,
+                                                   cache=self.trees.cache)
+        paradigms = []
+        lemmas = self.morph_db.lemmatize_many([word.strip().lower()] * len(scores), [par for _, par in scores])
+        for (score, par), lemma in zip(scores, lemmas):
+            paradigms.append({"paradigm": par, "score": score, "lemma": lemma,
+                              "forms": sorted(self.morph_db.lemma_forms(lemma, par))})
+        return paradigms
+
+
+def request_words(request: Dict[str, Any]) -> List[str]:
+    """Returns words of a request, given either as list "words" or as single "word". Raises ValueError for
+    malformed request."""
+    words = request["words"] if "words" in request else [request.get("word", "")]
+    if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+        raise ValueError("words have to be given as string or list of strings")
+    return words
+
+
+class GuessHandler(socketserver.StreamRequestHandler):
+    """Reads JSON requests from client line by line and writes JSON responses."""
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request has to be a JSON object")
+                request_words(request)
+            except ValueError as e:
+                response = {"error": f"invalid request: {e}"}
+            else:
+                response = self.server.guesser.submit(request)
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class UnixGuessServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class TCPGuessServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Serves paradigm guessing over a socket (JSON lines)")
+    parser.add_argument("-s", "--use-segmenter", default="character",
+                        help="use segmentation for words (if not specified, not using any)")
+    parser.add_argument("-u", "--socket", default=f"temp{os.sep}guesser.sock",
+                        help="path of Unix socket to listen on")
+    parser.add_argument("-p", "--port", type=int, help="listen on TCP port of localhost instead of Unix socket")
+    parser.add_argument("-n", "--numpy", action="store_true", default=False,
+                        help="score paradigms with vectorized NumPy spread matrix")
+    parser.add_argument("-w", "--batch-wait", type=float, default=5.0,
+                        help="milliseconds to wait for more requests to join a batch")
+    args = parser.parse_args()
+    if not os.path.exists(f".{os.sep}temp"):
+        os.mkdir(f".{os.sep}temp")
+    fl = f"data{os.sep}cstenten17_mj2.freqlist.cleaned.sorted_alpha"
+    morph_db = md.load_database(f"data{os.sep}current.dic", f"data{os.sep}current.par", freq_list=f"{fl}.filtered")
+    fl = f"{fl}.{args.use_segmenter if args.use_segmenter else 'character'}"
+    if not os.path.exists(fl):
+        print(fl, ": file not found", file=stderr)
+        return
+    trees = dbs.FreqTreeLoader(fl, whole=True)
+    trees.tree_for("")
+    guess_server = GuessServer(morph_db, g.cached_segment_method(args.use_segmenter), trees,
+                               dbs.SpreadMatrix(morph_db) if args.numpy else None, args.batch_wait / 1000)
+    if args.port is not None:
+        server = TCPGuessServer(("localhost", args.port), GuessHandler)
+    else:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixGuessServer(args.socket, GuessHandler)
+    server.guesser = guess_server
+    print(f"listening on {args.socket if args.port is None else f'localhost:{args.port}'}", file=stderr)
+    with server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,15 @@
 """This file contains tools for paradigm guessing."""
 import os
 import db_stats as dbs
+import instrument
 import morph_database as md
 from typing import List, TextIO, Tuple
 
 
 def tree_guess_paradigm_from_corpus(segments: str, tree: dbs.FreqTreeNode, morph_db: md.MorphDatabase, scoring,
-                                    only_lemmas: bool = False) -> List[Tuple[float, str]]:
+                                    only_lemmas: bool = False, matrix: dbs.SpreadMatrix = None,
+                                    spread_delta: dbs.SPREAD_DELTA = None, cache: dbs.SuffixCache = None
+                                    ) -> List[Tuple[float, str]]:
     """Guesses paradigm of given word based on occurrences of similar words in given corpus and their spread.
     Returns sorted list of tuples (paradigm, score (greater the better))."""
     result = [(score, par) for par, score in dbs.tree_spread_scores(
@@ -15,48 +18,182 @@ def tree_guess_paradigm_from_corpus(segments: str, tree: dbs.FreqTreeNode, morph
         tree,
         morph_db,
         scoring=scoring,
-        only_lemmas=only_lemmas
+        only_lemmas=only_lemmas,
+        matrix=matrix,
+        spread_delta=spread_delta,
+        cache=cache
     ).items()
               ]
     result.sort(reverse=True)
     return result
 
 
-def get_segment_method(seg_tool: str):
-    """Creates desired segmentation method."""
-    character = (lambda x: list(c for c in x))
+def segment_model(seg_tool: str) -> str:
+    """Returns path of trained model (or loaded vocabulary) of given segmenter, training and storing it first if
+    it is not cached yet. Models are cached in temp directory under names given by segmenter ID and hash
+    of training data, so they are rebuilt only when the data change. Returns empty string for segmenters
+    without a model."""
     if "sentencepiece" in seg_tool:
         import sentencepiece as sp
         params = seg_tool.split("_")
         if len(params) != 3:
-            return character
-        if not os.path.exists(f'temp{os.sep}{params[1]}_{params[2]}.model'):
+            return ""
+        model = cached_model(seg_tool, f"desam{os.sep}prevert_desam", "model")
+        if not os.path.exists(model):
+            prefix = model[:-len(".model")]
             sp.SentencePieceTrainer.train(f'--input=desam{os.sep}prevert_desam'
-                                          f' --model_prefix=temp{os.sep}{params[1]}_{params[2]}'
+                                          f' --model_prefix={prefix}.{os.getpid()}.tmp'
                                           f' --model_type={params[1]} --vocab_size={params[2]}'
                                           f' --user_defined_symbols=<doc>,</doc>,<head>,</head>,<s>,</s>,<phr>,</phr>')
-        m = sp.SentencePieceProcessor()
-        m.load(f"temp{os.sep}{params[1]}_{params[2]}.model")
-        return m.encode_as_pieces
+            os.replace(f"{prefix}.{os.getpid()}.tmp.vocab", f"{prefix}.vocab")
+            os.replace(f"{prefix}.{os.getpid()}.tmp.model", model)
+        return model
     elif "morfessor" in seg_tool:
         import morfessor as mo
         params = seg_tool.split("_")
         max_epochs = 4
         if len(params) == 2 and params[1].isdigit():
             max_epochs = int(params[1])
-        io = mo.MorfessorIO()
-        train_data = list(io.read_corpus_file(f"desam{os.sep}prevert_desam"))
-        model = mo.BaselineModel()
-        model.load_data(train_data, count_modifier=lambda x: 1)
-        model.train_batch(algorithm="viterbi", max_epochs=max_epochs)
-        return lambda x: model.viterbi_segment(x, maxlen=5)[0]
+        cached = cached_model(f"morfessor_{max_epochs}", f"desam{os.sep}prevert_desam", "bin")
+        if not os.path.exists(cached):
+            io = mo.MorfessorIO()
+            train_data = list(io.read_corpus_file(f"desam{os.sep}prevert_desam"))
+            model = mo.BaselineModel()
+            model.load_data(train_data, count_modifier=lambda x: 1)
+            model.train_batch(algorithm="viterbi", max_epochs=max_epochs)
+            io.write_binary_model_file(f"{cached}.tmp", model)
+            os.replace(f"{cached}.tmp", cached)
+        return cached
     elif "hft" in seg_tool:
+        import pickle
         import hftok.hftoks as hft
-        vocab = hft.read_vocab(f"hftok{os.sep}desam.vocab")
+        cached = cached_model("hft", f"hftok{os.sep}desam.vocab", "pickle")
+        if not os.path.exists(cached):
+            vocab = hft.read_vocab(f"hftok{os.sep}desam.vocab")
+            with open(f"{cached}.tmp", "wb") as c:
+                pickle.dump(vocab, c, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{cached}.tmp", cached)
+        return cached
+    return ""
+
+
+def get_segment_method(seg_tool: str, model: str = ""):
+    """Creates desired segmentation method from given model file (see segment_model), or from cached model
+    trained first if needed when no model is given."""
+    character = (lambda x: list(c for c in x))
+    if not model and any(tool in seg_tool for tool in ("sentencepiece", "morfessor", "hft")):
+        model = segment_model(seg_tool)
+    if not model:
+        return character
+    if "sentencepiece" in seg_tool:
+        import sentencepiece as sp
+        m = sp.SentencePieceProcessor()
+        m.load(model)
+        return m.encode_as_pieces
+    elif "morfessor" in seg_tool:
+        import morfessor as mo
+        morfessor_model = mo.MorfessorIO().read_binary_model_file(model)
+        return lambda x: morfessor_model.viterbi_segment(x, maxlen=5)[0]
+    elif "hft" in seg_tool:
+        import pickle
+        import hftok.hftoks as hft
+        with open(model, "rb") as c:
+            vocab = pickle.load(c)
         return lambda x: hft.tokenize_string(x.lower(), vocab)
     return character
 
 
+class SegmentationCache:
+    """Segmentation method backed by persistent cache of segmentations (SQLite database shared by all runs
+    and processes) with in-memory LRU cache in front. The segmentation model is trained on creation if it is
+    not cached yet, but loaded only when a word is missing in the cache. Segmentations are keyed by file name
+    of the model (see segment_model), which contains hash of its training data, so results of a retrained
+    model do not mix with the old ones. New segmentations are stored in batches, call flush to store the rest.
+    The cache may be used from several threads, each of them opens its own database connection."""
+    def __init__(self, seg_tool: str, db_file: str = f"temp{os.sep}segmentations.sqlite", size: int = 100000,
+                 batch: int = 10000, model: str = ""):
+        import threading
+        from collections import OrderedDict
+        self.seg_tool = seg_tool
+        self.model = model or segment_model(seg_tool)
+        self.key = os.path.basename(self.model) if self.model else seg_tool
+        self.db_file = db_file
+        self.method = None
+        self.size = size
+        self.batch = batch
+        self.recent = OrderedDict()
+        self.pending = []
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        if not os.path.exists(os.path.dirname(db_file) or "."):
+            os.mkdir(os.path.dirname(db_file))
+        self.connection()
+
+    def connection(self):
+        """Returns database connection of current thread, opened on its first use."""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            import sqlite3
+            db = sqlite3.connect(self.db_file, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS segmentations (segmenter TEXT, word TEXT, pieces TEXT, "
+                       "PRIMARY KEY (segmenter, word)) WITHOUT ROWID")
+            self.local.db = db
+        return db
+
+    def __call__(self, word: str) -> List[str]:
+        with self.lock:
+            if word in self.recent:
+                self.recent.move_to_end(word)
+                return list(self.recent[word])
+            row = self.connection().execute("SELECT pieces FROM segmentations WHERE segmenter = ? AND word = ?",
+                                            (self.key, word)).fetchone()
+            if row is not None:
+                pieces = tuple(row[0].split("\x1f")) if row[0] else tuple()
+            else:
+                if self.method is None:
+                    self.method = get_segment_method(self.seg_tool, self.model)
+                pieces = tuple(self.method(word))
+                self.pending.append((self.key, word, "\x1f".join(pieces)))
+                if len(self.pending) >= self.batch:
+                    self.flush()
+            self.recent[word] = pieces
+            if len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+            return list(pieces)
+
+    def flush(self) -> None:
+        """Stores pending segmentations to the database."""
+        with self.lock:
+            if self.pending:
+                db = self.connection()
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO segmentations VALUES (?, ?, ?)", self.pending)
+                self.pending = []
+
+
+def cached_segment_method(seg_tool: str, model: str = ""):
+    """Returns segmentation method for given segmenter ID (and model file, see segment_model), with cached results
+    for segmenters which use a model. Segmenting by characters is not cached."""
+    if any(tool in seg_tool for tool in ("sentencepiece", "morfessor", "hft")):
+        return SegmentationCache(seg_tool, model=model)
+    return get_segment_method(seg_tool, model)
+
+
+def flush_segmentations(segment) -> None:
+    """Stores pending results of segmentation method, if it is cached."""
+    if isinstance(segment, SegmentationCache):
+        segment.flush()
+
+
+def cached_model(seg_tool: str, source: str, extension: str) -> str:
+    """Returns path of cached model for given segmenter ID (including its parameters) trained from given source
+    file. The path contains hash of the source file content."""
+    if not os.path.exists("temp"):
+        os.mkdir("temp")
+    return f"temp{os.sep}{seg_tool}_{md.file_hash(source)[:16]}.{extension}"
+
+
 def prevert_desam():
     import re
     f = open("desam/desam", "r", encoding="utf-8")
@@ -79,41 +216,67 @@ def prevert_desam():
     f.close()
 
 
-def main(source: TextIO, only_lemmas: bool = False, seg_tool: str = "character", debug: bool = False):
-    from sys import stderr
+def format_guess(word: str, segmentation: str, scores: List[Tuple[float, str]], morph_db: md.MorphDatabase,
+                 output_format: str = "text", debug: bool = False) -> str:
+    """Returns output lines for five best guessed paradigms of a word in given format: text (as printed by
+    db_stats.print_scores, or verbose with lemmas and forms if debug is set), ndjson (one JSON object per word)
+    or tsv (one line <word paradigm score> per paradigm)."""
+    best = scores[:min(5, len(scores))]
+    if output_format == "ndjson":
+        import json
+        return json.dumps({"word": word, "paradigms": [{"paradigm": par, "score": score} for score, par in best]},
+                          ensure_ascii=False) + "\n"
+    if output_format == "tsv":
+        return "".join(f"{word}\t{par}\t{score}\n" for score, par in best) or f"{word}\t\t\n"
+    if not debug:
+        return dbs.format_scores(word, {par: score for score, par in best})
+    lines = [f"Word {word}, segmented as {segmentation}:"]
+    if not scores:
+        lines.append("\tNo paradigms guessed")
+    lemmas = morph_db.lemmatize_many([word.lower()] * len(best), [par for _, par in best])
+    for (score, par), lemma in zip(best, lemmas):
+        lines.append(f"\t{par}: score {score}, lemma {lemma}, forms {', '.join(morph_db.lemma_forms(lemma, par))}")
+    return "\n".join(lines) + "\n"
+
+
+def main(source: TextIO, only_lemmas: bool = False, seg_tool: str = "character", debug: bool = False,
+         compact: bool = False, use_numpy: bool = False, batch: int = 1, output_format: str = "text"):
+    """Guesses paradigms of words from source (one per line). Input is read in chunks of batch lines, words of
+    a chunk are grouped by the tree they need and results of the chunk are written at once in input order."""
+    from itertools import islice
+    from sys import stderr, stdout
     fl = "data/cstenten17_mj2.freqlist.cleaned.sorted_alpha"
     if debug:
         print("Building morphological database...")
-    morph_db = md.MorphDatabase(f"data{os.sep}current.dic", f"data{os.sep}current.par",
+    morph_db = md.load_database(f"data{os.sep}current.dic", f"data{os.sep}current.par",
                                 freq_list=f"{fl}.filtered")
     if debug:
         print(f"Creating segmentation function \'{seg_tool}\'...", file=stderr)
-    segment = get_segment_method(seg_tool)
+    segment = cached_segment_method(seg_tool)
     fl = f"data{os.sep}cstenten17_mj2.freqlist.cleaned.sorted_alpha.{seg_tool if seg_tool else 'character'}"
     if not os.path.exists(fl):
         print(fl, ": file not found", file=stderr)
         return
-    start_letter = ""
-    node = dbs.FreqTreeNode()
-    for line in source:
-        segments = dbs.uppercase_format("=".join(segment(line.strip().lower())))
-        if segments[0] != start_letter:
-            start_letter = segments[0]
-            if debug:
-                print(f"Building suffix tree for prefix \'{start_letter}\'...", file=stderr)
-            node = dbs.FreqTreeNode().feed(fl, start_letter)
-        if debug:
-            print(f"Word {line.strip()}, segmented as {'='.join(segment(line.strip().lower()))}:")
-        scores = tree_guess_paradigm_from_corpus(segments, node, morph_db, dbs.scoring_comm_square_spread_suf, only_lemmas)
-        if not debug:
-            dbs.print_scores(line.strip(), {par: score for score, par in scores[:min(5, len(scores))]})
-        else:
-            if not scores:
-                print("\tNo paradigms guessed")
-            for score, par in scores[:min(5, len(scores))]:
-                lemma = morph_db.lemmatize(line.strip().lower(), par)
-                print(f"\t{par}: score {score}, lemma {lemma}, "
-                      f"forms {', '.join(morph_db.lemma_forms(lemma, par))}")
+    trees = dbs.FreqTreeLoader(fl, whole=compact, debug=debug)
+    matrix = dbs.SpreadMatrix(morph_db) if use_numpy else None
+    while True:
+        words = [line.strip() for line in islice(source, max(batch, 1))]
+        if not words:
+            break
+        with instrument.stage("segmentation"):
+            segmentations = ["=".join(segment(word.lower())) for word in words]
+        segments = [dbs.uppercase_format(segmentation) for segmentation in segmentations]
+        results = [""] * len(words)
+        for i in sorted(range(len(words)), key=lambda j: trees.slice_key(segments[j])):
+            scores = tree_guess_paradigm_from_corpus(segments[i], trees.tree_for(segments[i]), morph_db,
+                                                     dbs.scoring_comm_square_spread_suf, only_lemmas, matrix,
+                                                     cache=trees.cache)
+            results[i] = format_guess(words[i], segmentations[i], scores, morph_db, output_format, debug)
+        with instrument.stage("output"):
+            stdout.write("".join(results))
+    flush_segmentations(segment)
+    if debug:
+        print(trees.cache, file=stderr)
 
 
 if __name__ == "__main__":
@@ -126,11 +289,27 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--use-segmenter", default="character",
                         help="use segmentation for words (if not specified, not using any)")
     parser.add_argument("-d", "--debug", action="store_true", help="verbose output", default=False)
+    parser.add_argument("-c", "--compact", action="store_true", default=False,
+                        help="load whole frequency list into compact tree at once instead of per-letter slices")
+    parser.add_argument("-n", "--numpy", action="store_true", default=False,
+                        help="score paradigms with vectorized NumPy spread matrix")
+    parser.add_argument("-b", "--batch", type=int, default=1,
+                        help="number of input words read and guessed at once, grouped by needed tree")
+    parser.add_argument("-o", "--output-format", choices=["text", "ndjson", "tsv"], default="text",
+                        help="format of output (text is verbose with -d)")
+    parser.add_argument("-P", "--profile", default="",
+                        help="write stage timers and counters to PROFILE.json and cProfile dump to PROFILE.prof")
     args = parser.parse_args()
 
     if not os.path.exists(f".{os.sep}temp"):
         os.mkdir(f".{os.sep}temp")
     src = sys.stdin if args.infile is None else open(args.infile, encoding="utf-8")
-    main(src, args.lemma, args.use_segmenter, args.debug)
+    if args.profile:
+        instrument.enable(f"{args.profile}.prof")
+    main(src, args.lemma, args.use_segmenter, args.debug, args.compact, args.numpy, args.batch, args.output_format)
+    if args.profile:
+        instrument.dump_profile()
+        instrument.report(f"{args.profile}.json", {"segmenter": args.use_segmenter, "batch": args.batch,
+                                                   "compact": args.compact, "numpy": args.numpy})
     if args.infile is None:
         src.close()
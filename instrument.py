@@ -0,0 +1,162 @@
+"""This file contains opt-in instrumentation of the guessing pipeline: per-stage timers, counters, peak memory
+sample, JSON report and cProfile dumps. Nothing is measured until enable is called."""
+import os
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+from typing import Any, Dict, List, Tuple
+
+ENABLED = False
+TIMERS = dict()
+COUNTERS = dict()
+PROFILER = dict()
+
+
+def enable(profile_file: str = "") -> None:
+    """Starts collecting timers and counters in current process, and also cProfile statistics to be dumped
+    to profile_file if it is given."""
+    global ENABLED
+    ENABLED = True
+    if profile_file:
+        import cProfile
+        if "profile" in PROFILER:
+            PROFILER["profile"].disable()
+        for file in worker_profiles(profile_file):
+            os.remove(file)
+        PROFILER["file"] = profile_file
+        PROFILER["profile"] = cProfile.Profile()
+        PROFILER["profile"].enable()
+
+
+def settings() -> Tuple[bool, str]:
+    """Returns whether instrumentation is enabled and name of profile file, to be passed to worker processes
+    (see enable_worker)."""
+    return ENABLED, PROFILER.get("file", "")
+
+
+def enable_worker(worker_settings: Tuple[bool, str]) -> None:
+    """Enables instrumentation in worker process according to settings of the main process. Profile of the
+    worker is dumped to file with its process id appended, to be merged by dump_profile of the main process.
+    Measurements inherited from the main process (when
+    forked) are discarded."""
+    enabled, profile_file = worker_settings
+    TIMERS.clear()
+    COUNTERS.clear()
+    if enabled:
+        enable(f"{profile_file}.{os.getpid()}" if profile_file else "")
+
+
+@contextmanager
+def stage(name: str):
+    """Measures time spent in the block as a stage of given name. Stages may be nested, their times are
+    inclusive. The context manager costs a generator even when disabled, hot paths should check ENABLED
+    first."""
+    if not ENABLED:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, perf_counter() - start)
+
+
+def timed(name: str):
+    """Decorator measuring each call of a function as a stage of given name. The wrapper adds a call even when
+    disabled, so it is meant for functions called rarely (loading, building)."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(name, perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def add_time(name: str, seconds: float, calls: int = 1) -> None:
+    """Adds time and number of calls to stage of given name."""
+    timer = TIMERS.setdefault(name, [0.0, 0])
+    timer[0] += seconds
+    timer[1] += calls
+
+
+def count(name: str, n: int = 1) -> None:
+    """Increases counter of given name."""
+    if ENABLED:
+        COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+
+def peak_rss() -> int:
+    """Returns peak resident set size of current process and its finished children in kilobytes (0 where not
+    available)."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if os.uname().sysname == "Darwin":
+        self_rss, children_rss = self_rss // 1024, children_rss // 1024
+    return max(self_rss, children_rss)
+
+
+def snapshot(reset: bool = False) -> Dict[str, Any]:
+    """Returns collected timers and counters of current process (e.g. to be merged in the main process).
+    If reset is set, they are cleared afterwards."""
+    data = {"timers": {name: list(timer) for name, timer in TIMERS.items()}, "counters": dict(COUNTERS),
+            "peak_rss_kb": peak_rss()}
+    if reset:
+        TIMERS.clear()
+        COUNTERS.clear()
+    return data
+
+
+def merge(other: Dict[str, Any]) -> None:
+    """Adds timers and counters from snapshot of another process."""
+    for name, (seconds, calls) in other["timers"].items():
+        add_time(name, seconds, calls)
+    for name, n in other["counters"].items():
+        COUNTERS[name] = COUNTERS.get(name, 0) + n
+    COUNTERS["worker_peak_rss_kb"] = max(COUNTERS.get("worker_peak_rss_kb", 0), other["peak_rss_kb"])
+
+
+def dump_profile() -> None:
+    """Stores cProfile statistics of current process (readable by pstats or snakeviz) to its profile file, if
+    profiling was enabled. Profiles dumped by worker processes (see enable_worker) are merged into it and
+    removed."""
+    if "profile" in PROFILER:
+        import pstats
+        PROFILER["profile"].disable()
+        stats = pstats.Stats(PROFILER["profile"])
+        workers = worker_profiles(PROFILER["file"])
+        for file in workers:
+            stats.add(file)
+        stats.dump_stats(PROFILER["file"])
+        for file in workers:
+            os.remove(file)
+        PROFILER["profile"].enable()
+
+
+def worker_profiles(profile_file: str) -> List[str]:
+    """Returns existing profile files of worker processes for given profile file of the main process."""
+    import glob
+    return [file for file in glob.glob(f"{glob.escape(profile_file)}.*") if file.rsplit(".", 1)[1].isdigit()]
+
+
+def report(file: str, info: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Writes JSON report of stages (total seconds, calls), counters and peak memory, with given additional
+    information (e.g. segmenter and options), to file. Returns the report."""
+    import json
+    stages = {name: {"seconds": round(seconds, 6), "calls": calls} for name, (seconds, calls) in TIMERS.items()}
+    counters = dict(COUNTERS)
+    if counters.get("words"):
+        counters["candidates_per_word"] = round(counters.get("candidates", 0) / counters["words"], 3)
+    data = {"info": info or dict(), "stages": stages, "counters": counters, "peak_rss_kb": peak_rss()}
+    with open(file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    return data
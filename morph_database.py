@@ -1,20 +1,32 @@
 """This file contains tools for creating and using morphological database."""
-from typing import Tuple, Dict, List, Set, Any
+import instrument
+from sys import intern
+from typing import Tuple, Dict, FrozenSet, List, Set, Any
 
 AFFIXES = Dict[str, List[Tuple[str, List[str]]]]
 PAR_DATA = Dict[str, Any]
 DB_PARADIGMS = Dict[str, PAR_DATA]
 DB_VOCABULARY = List[Tuple[str, str]]
+SNAPSHOT_VERSION = 5
 
 
 class MorphDatabase:
     """This class represents morphological database obtained from dictionary and paradigm files. Holds
-    attributes vocab (dictionary lemma:paradigm) and paradigms (paradigm:suffixes and tags)."""
+    attributes vocab (dictionary lemma:paradigm) and paradigms (paradigm:suffixes and tags). Paradigms are
+    also indexed by their affixes: paradigm_ids lists paradigms by their numeric ids, suffix_paradigms maps
+    each suffix to sorted ids of paradigms containing it, suffix_ids numbers all suffixes and affix_bits holds
+    affixes of each paradigm as a bitset of suffix ids. For lemmatization, lemma_affixes holds the base form
+    suffix, set of affixes and their distinct lengths (descending) of each paradigm. Comparisons of paradigms
+    are memoized in comparisons, lemmas of words by paradigm in lemma_memo. All suffixes are kept in frozen
+    set suffixes and reversed in trie suffix_trie (nested dictionaries of characters, key "" marks end
+    of a suffix). Optional index of word forms can be built by index_forms."""
 
     def __init__(self, dic_file: str, par_file: str, freq_list: str = "", only_formal: bool = False):
         self.vocab = []
+        self.forms = None
         self.paradigms = paradigm_db(par_file, only_formal)
         self.paradigm_suffixes()
+        self.index_paradigms()
         if dic_file:
             self.vocab = vocabulary(dic_file)
         if freq_list:
@@ -22,6 +34,8 @@ class MorphDatabase:
 
     def form_present(self, word: str) -> bool:
         """Checks whether given word form is present in database."""
+        if self.forms is not None:
+            return word in self.forms
         for (lemma, paradigm) in self.vocab:
             if self.paradigms[paradigm]["<suffix>"] != paradigm and word[0] != lemma[0].lower():
                 continue
@@ -29,6 +43,43 @@ class MorphDatabase:
                 return True
         return False
 
+    def index_forms(self, forms_file: str = "") -> None:
+        """Builds index from (lowercase) word forms to pairs (lemma, paradigm) producing them. Forms are computed
+        from vocabulary, or read from file of lines <form:lemma:paradigm> created by dic_file_all_forms."""
+        self.forms = dict()
+        if not forms_file:
+            for entry in self.vocab:
+                for form in self.lemma_forms(entry[0].lower(), entry[1]):
+                    self.index_form(form, entry)
+            return
+        entries = {entry: entry for entry in self.vocab}
+        with open(forms_file, encoding="utf-8") as f:
+            for line in f:
+                form, lemma, paradigm = line.rstrip("\n").split(":")
+                entry = entries.setdefault((lemma, paradigm), (lemma, paradigm))
+                self.index_form(form.lower(), entry)
+
+    def index_form(self, form: str, entry: Tuple[str, str]) -> None:
+        """Adds form of lemma with paradigm to form index. Single pair is stored as it is, more pairs as a list."""
+        lemma, paradigm = entry
+        # same restriction as in form_present without index
+        if self.paradigms[paradigm]["<suffix>"] != paradigm and form[:1] != lemma[:1].lower():
+            return
+        known = self.forms.get(form)
+        if known is None:
+            self.forms[form] = entry
+        elif isinstance(known, list):
+            known.append(entry)
+        else:
+            self.forms[form] = [known, entry]
+
+    def form_sources(self, word: str) -> List[Tuple[str, str]]:
+        """Returns all pairs (lemma, paradigm) producing given word form. Builds form index if not present."""
+        if self.forms is None:
+            self.index_forms()
+        known = self.forms.get(word, [])
+        return list(known) if isinstance(known, list) else [known]
+
     def lemma_forms(self, lemma: str, paradigm: str) -> Set[str]:
         """Returns set of all forms for given lemma and paradigm."""
         forms = set()
@@ -69,6 +120,43 @@ class MorphDatabase:
                     self.paradigms[paradigm]["<suffix>"] = paradigm[len(lemma) - len(suffix):]
                     break
 
+    def index_paradigms(self) -> None:
+        """Builds inverted index from suffixes to paradigms and affix bitsets of paradigms."""
+        self.paradigm_ids = list(self.paradigms.keys())
+        self.lemma_suffixes = []
+        self.suffix_ids = dict()
+        self.suffix_paradigms = dict()
+        self.affix_bits = []
+        for i, paradigm in enumerate(self.paradigm_ids):
+            self.lemma_suffixes.append(self.paradigms[paradigm]["<suffix>"].split("_")[0])
+            bits = 0
+            for affix in self.paradigms[paradigm]["affixes"].keys():
+                bits |= 1 << self.suffix_ids.setdefault(affix, len(self.suffix_ids))
+                self.suffix_paradigms.setdefault(affix, []).append(i)
+            self.affix_bits.append(bits)
+        self.lemma_affixes = dict()
+        for i, paradigm in enumerate(self.paradigm_ids):
+            affixes = frozenset(self.paradigms[paradigm]["affixes"].keys())
+            lengths = tuple(sorted({len(affix) for affix in affixes}, reverse=True))
+            self.lemma_affixes[paradigm] = (self.lemma_suffixes[i], affixes, lengths)
+        self.suffixes = frozenset(self.suffix_ids)
+        self.suffix_trie = dict()
+        for suffix in self.suffixes:
+            node = self.suffix_trie
+            for char in reversed(suffix):
+                node = node.setdefault(char, dict())
+            node[""] = True
+        self.comparisons = dict()
+        self.lemma_memo = dict()
+
+    def suffix_bits(self, suffixes) -> int:
+        """Returns bitset of ids of given suffixes. Suffixes not present in database are omitted."""
+        bits = 0
+        for suffix in suffixes:
+            if suffix in self.suffix_ids:
+                bits |= 1 << self.suffix_ids[suffix]
+        return bits
+
     def form_spread(self, freq_list: str) -> None:
         """Computes absolute spread of given forms in corpus characterized by its alphabetically sorted
         filtered frequency list."""
@@ -84,12 +172,23 @@ class MorphDatabase:
                                                         len(self.paradigms[paradigm]["<suffix>"].split("_")[0]):]] \
                     += int(values[3])
 
-    def all_suffixes(self) -> Set[str]:
+    def all_suffixes(self) -> FrozenSet[str]:
         """Returns set of all suffixes present in database."""
-        found = set()
-        for data in self.paradigms.values():
-            found |= data["affixes"].keys()
-        return found
+        return self.suffixes
+
+    def suffix_boundaries(self, word: str) -> List[int]:
+        """Returns ascending positions i < len(word) such that word[i:] is a suffix present in database. Word is
+        read once from its end in the reversed-suffix trie."""
+        boundaries = []
+        node = self.suffix_trie
+        for i in range(len(word) - 1, -1, -1):
+            node = node.get(word[i])
+            if node is None:
+                break
+            if "" in node:
+                boundaries.append(i)
+        boundaries.reverse()
+        return boundaries
 
     def dic_file_all_forms(self, dic_file: str) -> None:
         """Creates a file with all forms present in database."""
@@ -100,7 +199,15 @@ class MorphDatabase:
         outfile.close()
 
     def paradigm_comp(self, this: str, other: str, criterion: str, threshold: int = -1) -> bool:
-        """Checks whether two paradigms conform to given criterion."""
+        """Checks whether two paradigms conform to given criterion. Answers are memoized in comparison table
+        of the criterion."""
+        table = self.comparisons.setdefault((criterion, threshold), dict())
+        if (this, other) not in table:
+            table[(this, other)] = self.compare_paradigms(this, other, criterion, threshold)
+        return table[(this, other)]
+
+    def compare_paradigms(self, this: str, other: str, criterion: str, threshold: int = -1) -> bool:
+        """Checks whether two paradigms conform to given criterion (without memoization)."""
         if this not in self.paradigms.keys() or other not in self.paradigms.keys():
             return False
         if criterion == "same_paradigms":
@@ -119,20 +226,79 @@ class MorphDatabase:
                                                   == other_tag[other_tag.index("g") + 1]))
 
     def same_lemma(self, word: str, this: str, other: str) -> bool:
-        """Check whether two paradigms lemmatize given word the same."""
+        """Check whether two paradigms lemmatize given word the same. Lemmas are memoized."""
         if this not in self.paradigms.keys() or other not in self.paradigms.keys():
             return False
-        return self.lemmatize(word, this) == self.lemmatize(word, other)
+        missing = [paradigm for paradigm in (this, other) if (word, paradigm) not in self.lemma_memo]
+        for paradigm, lemma in zip(missing, self.lemmatize_many([word] * len(missing), missing)):
+            self.lemma_memo[(word, paradigm)] = lemma
+        return self.lemma_memo[(word, this)] == self.lemma_memo[(word, other)]
 
     def lemmatize(self, form: str, paradigm: str, prefix: str = "") -> str:
-        """Returns base form of a word with respect to given paradigm."""
+        """Returns base form of a word with respect to given paradigm. The longest affix of the paradigm ending
+        the form is looked up by lengths of affixes, from the longest."""
+        base, affixes, lengths = self.lemma_affixes[paradigm]
         if prefix:
-            return prefix + self.paradigms[paradigm]["<suffix>"].split("_")[0]
-        longest_suffix = ""
-        for suffix in self.paradigms[paradigm]["affixes"].keys():
-            if form.endswith(suffix) and len(suffix) > len(longest_suffix):
-                longest_suffix = suffix
-        return form[:len(form) - len(longest_suffix)] + self.paradigms[paradigm]["<suffix>"].split("_")[0]
+            return prefix + base
+        for length in lengths:
+            if length <= len(form) and form[len(form) - length:] in affixes:
+                return form[:len(form) - length] + base
+        return form + base
+
+    def lemmatize_many(self, forms: List[str], paradigms: List[str]) -> List[str]:
+        """Returns base forms of given word forms, each with respect to paradigm at the same position."""
+        return [self.lemmatize(form, paradigm) for form, paradigm in zip(forms, paradigms)]
+
+
+@instrument.timed("load_database")
+def load_database(dic_file: str, par_file: str, freq_list: str = "", only_formal: bool = False,
+                  cache_dir: str = "temp") -> MorphDatabase:
+    """Returns morphological database from its snapshot in cache directory. Snapshot is used only if it has
+    current version and all its source files have the same size and modification time (or content hash),
+    otherwise the database is built from scratch and a new snapshot is stored."""
+    import hashlib
+    import os
+    import pickle
+    sources = [f for f in (dic_file, par_file, freq_list) if f]
+    key = hashlib.sha1(repr(([os.path.abspath(f) for f in sources], only_formal)).encode("utf-8")).hexdigest()
+    snapshot = os.path.join(cache_dir, f"morph_db_{key[:16]}.pickle")
+    stats = [(os.path.getsize(f), os.stat(f).st_mtime_ns) for f in sources]
+    if os.path.exists(snapshot):
+        with open(snapshot, "rb") as s:
+            header = pickle.load(s)
+            if header["version"] == SNAPSHOT_VERSION and len(header["sources"]) == len(sources):
+                if header["stats"] == stats:
+                    return pickle.load(s)
+                if [file_hash(f) for f in sources] == header["hashes"]:
+                    morph_db = pickle.load(s)
+                    save_snapshot(snapshot, morph_db, stats, header["hashes"], sources)
+                    return morph_db
+    morph_db = MorphDatabase(dic_file, par_file, freq_list, only_formal)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_snapshot(snapshot, morph_db, stats, [file_hash(f) for f in sources], sources)
+    return morph_db
+
+
+def save_snapshot(snapshot: str, morph_db: MorphDatabase, stats: List[Tuple[int, int]], hashes: List[str],
+                  sources: List[str]) -> None:
+    """Stores versioned snapshot of morphological database with information about its source files."""
+    import os
+    import pickle
+    with open(f"{snapshot}.tmp", "wb") as s:
+        pickle.dump({"version": SNAPSHOT_VERSION, "sources": sources, "stats": stats, "hashes": hashes}, s,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(morph_db, s, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{snapshot}.tmp", snapshot)
+
+
+def file_hash(file: str) -> str:
+    """Returns SHA-1 hash of file content."""
+    import hashlib
+    digest = hashlib.sha1()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
 
 def paradigm_db(par_file: str, only_formal: bool = False) -> DB_PARADIGMS:
@@ -148,7 +314,7 @@ def paradigm_db(par_file: str, only_formal: bool = False) -> DB_PARADIGMS:
                     tags = affix[1]
                     if only_formal:
                         tags = list(filter(lambda x: "wH" not in x, tags))
-                    suffix = form + affix[0]
+                    suffix = intern(form + affix[0])
                     if tags:
                         translated[paradigm]["affixes"][suffix] = translated[paradigm].get(suffix, [])
                         translated[paradigm]["affixes"][suffix].extend(tags)
@@ -164,7 +330,7 @@ def vocabulary(dic_file: str) -> DB_VOCABULARY:
         if line.startswith(" ") or line.startswith("|") or not line.strip():
             continue
         lem_par = line.split("|")[0].split(":")
-        vocab.append((lem_par[0], lem_par[1].rstrip("!%\n")))
+        vocab.append((lem_par[0], intern(lem_par[1].rstrip("!%\n"))))
     d.close()
     return vocab
 
@@ -182,9 +348,9 @@ def read_paradigms(par_file: str) -> Tuple[DB_PARADIGMS, AFFIXES]:
             affixes[current] = list()
         elif line.startswith("\t{"):
             vals = line.lstrip("\t{").rstrip("}\n").split(",")
-            affixes[current].append(("" if vals[0] == "_" else vals[0], [vals[1].strip()]))
+            affixes[current].append((intern("" if vals[0] == "_" else vals[0]), [intern(vals[1].strip())]))
         elif line.startswith("+"):
-            current = line.lstrip("+").rstrip()
+            current = intern(line.lstrip("+").rstrip())
             database[current] = dict()
         elif line.startswith("\t<"):
             vals = line.strip().split()
@@ -193,6 +359,15 @@ def read_paradigms(par_file: str) -> Tuple[DB_PARADIGMS, AFFIXES]:
     return database, affixes
 
 
+# number of set bits in given bitset, counted by bin only before Python 3.10
+if hasattr(int, "bit_count"):
+    popcount = int.bit_count
+else:
+    def popcount(bits: int) -> int:
+        """Returns number of set bits in given bitset."""
+        return bin(bits).count("1")
+
+
 def correct_encoding(line: str) -> str:
     """Replaces wrongly encoded characters from dictionary and paradigm files"""
     return line.replace("ą", "š").replace("ľ", "ž").replace("»", "ť").replace("®", "Ž").replace("©", "Š")
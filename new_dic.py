@@ -1,15 +1,15 @@
 #!/usr/bin/env python3
 """This file serves for creating the new.dic file."""
 import morph_database as md
-import guesser as g
 import db_stats as dbs
-from typing import List
+from typing import List, Tuple
 import re
 
 DIC_FILE = "data/current.dic"
 PAR_FILE = "data/current.par"
 SEG_TOOL = "character"
 FREQ_LIST_FILTERED = "data/cstenten17_mj2.freqlist.cleaned.sorted_alpha.filtered"
+FREQ_LIST_SEGMENTED = "data/cstenten17_mj2.freqlist.cleaned.sorted_alpha.lowdrop.character"
 
 
 def line_to_include(data: List[str], morph_db: md.MorphDatabase) -> bool:
@@ -18,26 +18,66 @@ def line_to_include(data: List[str], morph_db: md.MorphDatabase) -> bool:
     return int(data[2]) > 100 and re.search("(.)\\1\\1", data[1]) is None and not morph_db.form_present(data[1])
 
 
-def main():
-    morph_db = md.MorphDatabase(DIC_FILE, PAR_FILE, freq_list=FREQ_LIST_FILTERED)
+WORKER = dict()
+
+
+def init_worker(morph_db: md.MorphDatabase, compact: bool) -> None:
+    """Prepares database and tree loader for guessing in current process."""
+    WORKER["morph_db"] = morph_db
+    WORKER["trees"] = dbs.FreqTreeLoader(FREQ_LIST_SEGMENTED, whole=compact)
+
+
+def guess_line(line: str) -> str:
+    """Returns line of new.dic for a line of segmented frequency list, or empty string if the word is not
+    included."""
+    morph_db = WORKER["morph_db"]
+    trees = WORKER["trees"]
+    data = line.strip().split()
+    if not line_to_include(data, morph_db):
+        return ""
+    segments = dbs.uppercase_format(data[0])
+    scores = dbs.best_spread_scores(segments, trees.tree_for(segments), morph_db, k=5, threshold=5,
+                                    cache=trees.cache)
+    if scores and morph_db.lemmatize(segments.lower(), scores[0][1]) == segments.lower():
+        return dbs.format_scores(data[1], {par: score for score, par in scores})
+    return ""
+
+
+def guess_block(block: Tuple[int, int]) -> str:
+    """Returns lines of new.dic for lines of segmented frequency list in given byte range."""
+    start, end = block
+    with open(FREQ_LIST_SEGMENTED, "rb") as fl:
+        fl.seek(start)
+        lines = fl.read(end - start).decode("utf-8").splitlines()
+    return "".join(guess_line(line) for line in lines)
+
+
+def main(compact: bool = False, jobs: int = 1):
+    """Creates new.dic from frequency list. With more jobs, the list is split into blocks of words starting
+    with the same letter, which are guessed in separate processes and written in the original order."""
+    morph_db = md.load_database(DIC_FILE, PAR_FILE, freq_list=FREQ_LIST_FILTERED)
+    morph_db.index_forms()
     outfile = open("new.dic", "w", encoding="utf-8")
-    start_letter = ""
-    with open(f"data/cstenten17_mj2.freqlist.cleaned.sorted_alpha.lowdrop.character", encoding="utf-8") as fl:
-        for line in fl:
-            data = line.strip().split()
-            if not line_to_include(data, morph_db):
-                continue
-            segments = dbs.uppercase_format(data[0])
-            if segments[0] != start_letter:
-                start_letter = segments[0]
-                node = dbs.FreqTreeNode().feed(f"data/cstenten17_mj2.freqlist.cleaned.sorted_alpha.lowdrop.character",
-                                               start_letter)
-            scores = g.tree_guess_paradigm_from_corpus(segments, node, morph_db, dbs.scoring_comm_square_spread_suf,
-                                                       only_lemmas=False)
-            if scores[0][0] > 5 and morph_db.lemmatize(segments.lower(), scores[0][1]) == segments.lower():
-                dbs.print_scores(data[1], {par: score for score, par in scores[:min(5, len(scores))]}, outfile=outfile)
+    if jobs > 1:
+        from multiprocessing import Pool
+        blocks = sorted(block for blocks in dbs.letter_index(FREQ_LIST_SEGMENTED).values() for block in blocks)
+        with Pool(jobs, initializer=init_worker, initargs=(morph_db, compact)) as pool:
+            for guessed in pool.imap(guess_block, blocks):
+                outfile.write(guessed)
+    else:
+        init_worker(morph_db, compact)
+        with open(FREQ_LIST_SEGMENTED, encoding="utf-8") as fl:
+            for line in fl:
+                outfile.write(guess_line(line))
     outfile.close()
 
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="Creates new.dic file from words missing in the database")
+    parser.add_argument("-c", "--compact", action="store_true", default=False,
+                        help="load whole frequency list into compact tree at once instead of per-letter slices")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes guessing blocks of words starting with the same letter")
+    args = parser.parse_args()
+    main(args.compact, args.jobs)
@@ -0,0 +1,74 @@
+"""Tests of the paradigm guessing server on synthetic data (see benchmark.generate)."""
+import json
+import socket
+import sqlite3
+import threading
+from typing import Any, Dict, List
+import benchmark
+import db_stats as dbs
+import guess_server as gs
+import guesser as g
+import morph_database as md
+
+
+def serve(tmp_path, monkeypatch, requests: List[Dict[str, Any]], flush=None) -> List[Dict[str, Any]]:
+    """Starts server with cached segmenter (segmenting by characters) on synthetic data, sends requests one
+    by one over Unix socket and returns the responses. Flush of the segmentation cache can be replaced."""
+    benchmark.generate(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    morph_db = md.MorphDatabase(benchmark.DIC_FILE, benchmark.PAR_FILE, f"{benchmark.FREQ_LIST}.filtered")
+    trees = dbs.FreqTreeLoader(f"{benchmark.FREQ_LIST}.character", whole=True)
+    segment = g.SegmentationCache("hft", db_file=str(tmp_path / "temp" / "segmentations.sqlite"),
+                                  model=str(tmp_path / "temp" / "hft_test.pickle"))
+    segment.method = list
+    if flush is not None:
+        segment.flush = flush
+    guess_server = gs.GuessServer(morph_db, segment, trees, batch_wait=0.0)
+    socket_file = str(tmp_path / "temp" / "guesser.sock")
+    server = gs.UnixGuessServer(socket_file, gs.GuessHandler)
+    server.guesser = guess_server
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    responses = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(30)
+            client.connect(socket_file)
+            reader = client.makefile(encoding="utf-8")
+            for request in requests:
+                client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+                responses.append(json.loads(reader.readline()))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return responses
+
+
+def test_cached_segmenter_request(tmp_path, monkeypatch):
+    """Request to a server with cached segmenter is answered from the scoring thread, although the cache was
+    created in the main thread."""
+    response, = serve(tmp_path, monkeypatch, [{"id": 1, "words": ["praha"], "top": 3}])
+    assert "error" not in response, response
+    assert response["id"] == 1
+    assert [result["word"] for result in response["results"]] == ["praha"]
+    assert len(response["results"][0]["paradigms"]) <= 3
+
+
+def test_failed_flush_keeps_serving(tmp_path, monkeypatch):
+    """Failure to store segmentations does not stop the scoring thread, later requests are answered."""
+    def flush():
+        raise sqlite3.OperationalError("database is locked")
+    responses = serve(tmp_path, monkeypatch, [{"id": 1, "word": "praha"}, {"id": 2, "word": "domu"}], flush)
+    assert [response.get("id") for response in responses] == [1, 2]
+    assert all("error" not in response for response in responses), responses
+
+
+def test_segmentation_cache_keyed_by_model(tmp_path):
+    """Segmentations cached for one model are not returned for a model trained from other data."""
+    db_file = str(tmp_path / "segmentations.sqlite")
+    old = g.SegmentationCache("hft", db_file=db_file, model=str(tmp_path / "hft_0123456789abcdef.pickle"))
+    old.method = list
+    assert old("praha") == ["p", "r", "a", "h", "a"]
+    old.flush()
+    new = g.SegmentationCache("hft", db_file=db_file, model=str(tmp_path / "hft_fedcba9876543210.pickle"))
+    new.method = lambda word: [word]
+    assert new("praha") == ["praha"]